@@ -1,4 +1,4 @@
-/* global dziNamesArray: false */
+/* global dziNamesArray: false, dziCatalog: false */
 /* eslint-disable no-unused-vars */
 
 var malakh;
@@ -26,11 +26,18 @@ function malakhCustom(containerSelectorOrElement, configOverrides) {
     initialAnimationTime = malakh.config.animationTime;
     initialMouseAnimationTime = malakh.config.mouseAnimationTime;
 
+    // Descriptors from a catalog written by utils/deepzoom_catalog.py --variable dziCatalog,
+    // if the page loads one; without it every DZI file gets fetched.
+    function getDescriptor(dziName) {
+        return typeof dziCatalog === 'undefined' ? undefined : dziCatalog[dziName];
+    }
+
     function openNorblinDZIsInARow() {
         dziDataArray = [];
         dziNamesArray.forEach(function (dziName, index) {
             dziDataArray[index] = {
                 imageDataUrl: dziPrefix + dziName + '.dzi',
+                descriptor: getDescriptor(dziName),
                 bounds: new Malakh.Rectangle(1000000, 1000000, 1000, 1000),
             };
         });
@@ -45,6 +52,7 @@ function malakhCustom(containerSelectorOrElement, configOverrides) {
         dziNamesArray.forEach(function (dziName, index) {
             dziDataArray[index] = {
                 imageDataUrl: dziPrefix + dziName + '.dzi',
+                descriptor: getDescriptor(dziName),
                 bounds: new Malakh.Rectangle(1000000, 1000000, 1000, 1000),
             };
         });
@@ -19,6 +19,8 @@
  * @param {number} options.tileSize Sets <code>this.tileSize</code>.
  * @param {number} options.tilesUrl Sets <code>this.tilesUrl</code>.
  * @param {number} options.tileFormat Sets <code>this.tileFormat</code>.
+ * @param {Object} [options.tileFormats] Sets <code>this.tileFormats</code>.
+ * @param {Object} [options.sparse] Sets <code>this.sparse</code>.
  * @param {number} [options.tileOverlap=0] Sets <code>this.tileOverlap</code>.
  * @param {Malakh.Rectangle} [options.bounds=new Malakh.Rectangle(0, 0, options.width, options.height)]
  *                              Sets <code>this.bounds</code>.
@@ -46,11 +48,47 @@ Malakh.DziImage = function DziImage(malakh, options) {
      */
     this.tilesUrl = options.tilesUrl;
     /**
-     * Format of tile files ('png' or 'jpg').
+     * Format of tile files ('png', 'jpg' or 'webp').
      *
      * @type string
      */
     this.fileFormat = options.fileFormat;
+    /**
+     * Formats of tiles on levels mixing formats: <code>formats</code> is an array of formats and
+     * <code>levels[level]</code> a string with an index to it for every tile of the level, row by row.
+     * Tiles on other levels are in <code>this.fileFormat</code>.
+     *
+     * @type Object
+     */
+    this.tileFormats = options.tileFormats || null;
+    /**
+     * Sparse manifest of a pyramid with tiles left out on purpose (written by
+     * <code>utils/my_deepzoom_pdf.py</code>): <code>minLevel</code> and <code>maxLevel</code>
+     * of the generated levels, <code>subtrees</code> mapping a "level/x_y" root of a one-color
+     * subtree to [the "level/x_y" tile to show for all of its tiles, its color] and
+     * <code>missing</code> listing [row, first column, last column] ranges of missing tiles by level.
+     *
+     * @type Object
+     */
+    this.sparse = options.sparse || null;
+    /**
+     * Missing tile ranges of <code>this.sparse</code> by level and row.
+     *
+     * @type Object
+     * @private
+     */
+    this.missingTiles = {};
+
+    if (this.sparse) {
+        this.minLevel = Math.max(this.minLevel, this.sparse.minLevel);
+        this.maxLevel = Math.min(this.maxLevel, this.sparse.maxLevel);
+        $.each(this.sparse.missing || {}, function (level, ranges) {
+            var rows = this.missingTiles[level] = {};
+            ranges.forEach(function (range) {
+                (rows[range[0]] = rows[range[0]] || []).push(range);
+            });
+        }.bind(this));
+    }
 };
 
 Malakh.DziImage.prototype = Object.create(Malakh.TiledImage.prototype);
@@ -69,7 +107,82 @@ $.extend(Malakh.DziImage.prototype,
          * @return {string}
          */
         getTileUrl: function getTileUrl(level, x, y) {
-            return this.tilesUrl + level + '/' + x + '_' + y + '.' + this.fileFormat;
+            var subtree = this.getSubtree(level, x, y);
+            if (subtree) {
+                // All tiles of a one-color subtree show the same file, fetched once.
+                var tile = subtree[0].split(/[\/_]/);
+                return this.tilesUrl + subtree[0] + '.' +
+                    this.getTileFormat(parseInt(tile[0], 10), parseInt(tile[1], 10), parseInt(tile[2], 10));
+            }
+            return this.tilesUrl + level + '/' + x + '_' + y + '.' + this.getTileFormat(level, x, y);
+        },
+
+        /**
+         * Returns the <code>this.sparse.subtrees</code> entry of the one-color subtree the tile
+         * belongs to, or null.
+         *
+         * @param {number} level The image level the tile lies on.
+         * @param {number} x Tile's column number (starting from 0).
+         * @param {number} y Tile's row number (starting from 0).
+         * @return {Array}
+         */
+        getSubtree: function getSubtree(level, x, y) {
+            var subtrees = this.sparse && this.sparse.subtrees;
+            if (!subtrees) {
+                return null;
+            }
+            for (; level >= 0; level--) {
+                var subtree = subtrees[level + '/' + x + '_' + y];
+                if (subtree) {
+                    return subtree;
+                }
+                x = Math.floor(x / 2);
+                y = Math.floor(y / 2);
+            }
+            return null;
+        },
+
+        /**
+         * Says if the tile's file exists, according to <code>this.sparse</code>.
+         *
+         * @param {number} level The image level the tile lies on.
+         * @param {number} x Tile's column number (starting from 0).
+         * @param {number} y Tile's row number (starting from 0).
+         * @return {boolean}
+         */
+        tileExists: function tileExists(level, x, y) {
+            if (!this.sparse) {
+                return true;
+            }
+            if (level < this.sparse.minLevel || level > this.sparse.maxLevel) {
+                return false;
+            }
+            var ranges = this.missingTiles[level] && this.missingTiles[level][y];
+            if (ranges) {
+                for (var i = 0; i < ranges.length; i++) {
+                    if (x >= ranges[i][1] && x <= ranges[i][2]) {
+                        return false;
+                    }
+                }
+            }
+            return true;
+        },
+
+        /**
+         * Returns tile's file format.
+         *
+         * @param {number} level The image level the tile lies on.
+         * @param {number} x Tile's column number (starting from 0).
+         * @param {number} y Tile's row number (starting from 0).
+         * @return {string}
+         */
+        getTileFormat: function getTileFormat(level, x, y) {
+            var levelFormats = this.tileFormats && this.tileFormats.levels[level];
+            if (!levelFormats) {
+                return this.fileFormat;
+            }
+            var index = y * this.getNumTiles(level).x + x;
+            return this.tileFormats.formats[levelFormats.charAt(index)];
         },
 
         /**
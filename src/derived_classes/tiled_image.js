@@ -327,6 +327,17 @@ $.extend(Malakh.TiledImage.prototype,
             return null;
         },
 
+        /**
+         * Says if the tile's file exists; tiles that don't aren't requested.
+         * @param {number} level The image level the tile lies on.
+         * @param {number} x Tile's column number (starting from 0).
+         * @param {number} y Tile's row number (starting from 0).
+         * @return {boolean}
+         */
+        tileExists: function tileExists(/* level, x, y */) {
+            return true;
+        },
+
         /**
          * Returns how much scaled is a pixel at a given level.
          * @param {number} level The image level.
@@ -692,23 +692,16 @@ Malakh.Controller = function Controller(malakh) {
     }
 
     /**
-     * Processes a DZI file, creating a <code>DziImage</code> instance.
+     * Parses a DZI file.
      *
-     * @param {Object} options An object containing all given options.
-     * @param {Document} options.data An object representing a DZI file.
-     * @param {string} options.imageDataUrl See <a href="#createFromDzi">
-     *                                      <code>Malakh.DziImage.createFromDzi</code></a>.
-     * @param {string} [options.tilesUrl] See <a href="#createFromDzi"><code>Malakh.DziImage.createFromDzi</code></a>
-     * @param {Document} [options.bounds] Bounds in which an image must fit. If not given, we assume the rectangle
-     *                                    <code>[0, 0, width x height]</code> where <code>width</code> and
-     *                                    <code>height</code> are taken from DZI.
-     * @return {Malakh.DziImage}
+     * @param {Document} data An object representing a DZI file.
+     * @return {Object} A descriptor, see <a href="#createFromDzi"><code>options.descriptor</code></a>.
      *
      * @memberof Malakh.Controller~
      * @private
      */
-    function processDzi(options) {
-        var imageNode = $(options.data.documentElement);
+    function parseDzi(data) {
+        var imageNode = $(data.documentElement);
         if (!imageNode || imageNode.prop('tagName') !== 'Image') {
             that.fail('Sorry, we only support Deep Zoom Image!');
         }
@@ -731,21 +724,70 @@ Malakh.Controller = function Controller(malakh) {
             that.fail(invalidFormatMessage);
         }
 
+        // Levels mixing tile formats list the format of every tile.
+        var tileFormats = null;
+        var tileFormatsNode = imageNode.children('TileFormats');
+        if (tileFormatsNode.length) {
+            tileFormats = {
+                formats: tileFormatsNode.attr('Formats').split(' '),
+                levels: {},
+            };
+            tileFormatsNode.children('Level').each(function () {
+                var levelNode = $(this);
+                tileFormats.levels[levelNode.attr('Index')] = $.trim(levelNode.text());
+            });
+        }
+
+        return {
+            width: width,
+            height: height,
+            tileSize: tileSize,
+            tileOverlap: tileOverlap,
+            fileFormat: fileFormat,
+            tileFormats: tileFormats,
+        };
+    }
+
+    /**
+     * Processes a DZI file, creating a <code>DziImage</code> instance.
+     *
+     * @param {Object} options An object containing all given options.
+     * @param {Document} [options.data] An object representing a DZI file; not needed if
+     *                                  <code>options.descriptor</code> is given.
+     * @param {Object} [options.descriptor] See <a href="#createFromDzi">
+     *                                      <code>Malakh.DziImage.createFromDzi</code></a>.
+     * @param {string} options.imageDataUrl See <a href="#createFromDzi">
+     *                                      <code>Malakh.DziImage.createFromDzi</code></a>.
+     * @param {string} [options.tilesUrl] See <a href="#createFromDzi"><code>Malakh.DziImage.createFromDzi</code></a>
+     * @param {Document} [options.bounds] Bounds in which an image must fit. If not given, we assume the rectangle
+     *                                    <code>[0, 0, width x height]</code> where <code>width</code> and
+     *                                    <code>height</code> are taken from DZI.
+     * @return {Malakh.DziImage}
+     *
+     * @memberof Malakh.Controller~
+     * @private
+     */
+    function processDzi(options) {
+        var descriptor = options.descriptor || parseDzi(options.data);
+
         // If tilesUrl were not provided, the default path is the same as imageDataUrl with ".dzi"
         // changed into "_files".
         var tilesUrl = options.tilesUrl || options.imageDataUrl.replace(/\.dzi$/, '_files/');
 
         if (!options.bounds) {
-            options.bounds = new Malakh.Rectangle(0, 0, width, height); // default bounds copied from DZI
+            // default bounds copied from DZI
+            options.bounds = new Malakh.Rectangle(0, 0, descriptor.width, descriptor.height);
         }
 
         return that.DziImage({
-            width: width,
-            height: height,
-            tileSize: tileSize,
-            tileOverlap: tileOverlap,
+            width: descriptor.width,
+            height: descriptor.height,
+            tileSize: descriptor.tileSize,
+            tileOverlap: descriptor.tileOverlap,
             tilesUrl: tilesUrl,
-            fileFormat: fileFormat,
+            fileFormat: descriptor.fileFormat,
+            tileFormats: descriptor.tileFormats || null,
+            sparse: options.sparse || descriptor.sparse || null,
             bounds: options.bounds,
         });
     }
@@ -763,10 +805,48 @@ Malakh.Controller = function Controller(malakh) {
      * @param {number} [options.index]  If specified, an image is loaded into
      *                                  <code>controller.tiledImages[index]</code>.
      *                                  Otherwise it's put at the end of the table.
+     * @param {Object} [options.descriptor]  Contents of the DZI file (<code>width</code>, <code>height</code>,
+     *                                       <code>tileSize</code>, <code>tileOverlap</code>,
+     *                                       <code>fileFormat</code> and optional <code>tileFormats</code>),
+     *                                       e.g. an entry of a catalog written by
+     *                                       <code>utils/deepzoom_catalog.py</code>. If given, the DZI file
+     *                                       isn't fetched.
+     * @param {Object} [options.sparse]  Sparse manifest of the image (see <code>Malakh.DziImage#sparse</code>),
+     *                                   catalog entries may contain it as well.
+     * @param {string} [options.sparseUrl]  The URL/path to the sparse manifest written next to the DZI
+     *                                      file (<code>name.sparse.json</code>), fetched first unless
+     *                                      <code>options.sparse</code> is given.
      */
     this.createFromDzi = function createFromDzi(options) {
         this.ensureOptions(options, 'DziImage.createFromDzi', ['imageDataUrl']);
 
+        if (options.sparseUrl && !options.sparse) {
+            $.ajax({
+                type: 'GET',
+                url: options.sparseUrl,
+                dataType: 'json',
+                success: function (sparse) {
+                    options.sparse = sparse;
+                    this.createFromDzi(options);
+                }.bind(this),
+                error: function () {
+                    // Without a manifest all tiles are requested.
+                    this.log('Unable to retrieve the sparse manifest under URL: "' + options.sparseUrl + '"');
+                    options.sparseUrl = null;
+                    this.createFromDzi(options);
+                }.bind(this),
+            });
+            return this;
+        }
+
+        if (options.descriptor) {
+            // Opened asynchronously like a fetched DZI, so that callers see the same order of events.
+            setTimeout(function () {
+                onOpen(processDzi(options), options.index);
+            });
+            return this;
+        }
+
         $.ajax({
             type: 'GET',
             url: options.imageDataUrl,
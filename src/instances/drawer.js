@@ -684,8 +684,9 @@ Malakh.Drawer = function Drawer(/* malakh */) {
                         } else {
                             updateAgain = true;
                         }
-                    } else if (!tile.loading) {
-                        // Means tile isn't loaded yet, so score it.
+                    } else if (!tile.loading && tiledImage.tileExists(adjustedLevel, x, y)) {
+                        // Means tile isn't loaded yet, so score it. Tiles left out of a sparse
+                        // pyramid are never requested, levels below them stay drawn.
                         var interestingPoint;
                         if (config.enableMagnifier) { // if magnifier shown, draw tiles close to its center
                             interestingPoint = magnifier.center;
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the tiling tools
+
+Generates synthetic sources in a work directory (noise images, images made
+of flat regions and multi-page vector PDFs) and runs ImageCreator.create,
+PyramidComposer.save and OverlayPyramid.run on them across source sizes,
+tile sizes and thread/worker counts. Every run happens in a fresh Python
+process so that its peak memory use can be measured.
+
+For each run the results record wall time, tiles/sec, per-level wall time,
+time spent per phase (ImageCreator only), peak RSS (of the run itself and
+of its child processes, e.g. pdftoppm or encoding workers) and the number
+of output bytes. They are written as JSON and can be compared with an
+earlier result file with --compare.
+
+PDF runs need pdftoppm (poppler-utils) and are skipped without it.
+
+Usage:
+    benchmark.py [options]
+"""
+
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from distutils.spawn import find_executable
+from PIL import Image
+
+import deepzoom
+import tilepack
+
+SOURCE_KINDS = ('noise', 'flat')
+
+
+def make_noise_image(path, size):
+    """Random pixels: the worst case for the encoders."""
+    width, height = size
+    Image.frombytes('RGB', size, os.urandom(width * height * 3)).save(path)
+
+def make_flat_image(path, size, seed=0):
+    """Large flat color regions on a white background, like scans with
+    margins: the best case for deduplication and blank tile detection."""
+    rng = random.Random(seed)
+    width, height = size
+    image = Image.new('RGB', size, (255, 255, 255))
+    for _ in xrange(32):
+        x, y = rng.randrange(width), rng.randrange(height)
+        w, h = rng.randrange(1, width // 4 + 2), rng.randrange(1, height // 4 + 2)
+        color = tuple(rng.randrange(256) for _ in xrange(3))
+        image.paste(color, (x, y, min(width, x + w), min(height, y + h)))
+    image.save(path)
+
+def make_vector_pdf(path, pages, size, seed=0):
+    """Writes a PDF of vector shapes and text, one random page after another.
+    size is the page size in points."""
+    rng = random.Random(seed)
+    width, height = size
+    objects = []
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(None)
+    pages_id = add(None)
+    font = add('<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+    page_ids = []
+    for page in xrange(pages):
+        ops = []
+        for _ in xrange(200):
+            ops.append('%.3f %.3f %.3f rg' % (rng.random(), rng.random(), rng.random()))
+            x, y = rng.uniform(0, width), rng.uniform(0, height)
+            kind = rng.randrange(3)
+            if kind == 0:
+                ops.append('%.2f %.2f %.2f %.2f re f' % (x, y, rng.uniform(1, width / 8.0),
+                                                         rng.uniform(1, height / 8.0)))
+            elif kind == 1:
+                ops.append('%.2f w %.2f %.2f m %.2f %.2f %.2f %.2f %.2f %.2f c S' % (
+                    rng.uniform(0.1, 4), x, y,
+                    rng.uniform(0, width), rng.uniform(0, height),
+                    rng.uniform(0, width), rng.uniform(0, height),
+                    rng.uniform(0, width), rng.uniform(0, height)))
+            else:
+                ops.append('BT /F1 %d Tf %.2f %.2f Td (Page %d lorem ipsum) Tj ET' % (
+                    rng.randrange(6, 48), x, y, page + 1))
+        stream = zlib.compress('\n'.join(ops))
+        contents = add('<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream'
+                       % (len(stream), stream))
+        page_ids.append(add('<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %s %s] '
+                            '/Contents %d 0 R /Resources << /Font << /F1 %d 0 R >> >> >>'
+                            % (pages_id, width, height, contents, font)))
+    objects[catalog - 1] = '<< /Type /Catalog /Pages %d 0 R >>' % pages_id
+    objects[pages_id - 1] = '<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        ' '.join('%d 0 R' % i for i in page_ids), len(page_ids))
+
+    with open(path, 'wb') as f:
+        f.write('%PDF-1.4\n')
+        offsets = []
+        for i, body in enumerate(objects):
+            offsets.append(f.tell())
+            f.write('%d 0 obj\n%s\nendobj\n' % (i + 1, body))
+        xref = f.tell()
+        f.write('xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+        for offset in offsets:
+            f.write('%010d 00000 n \n' % offset)
+        f.write('trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                % (len(objects) + 1, catalog, xref))
+
+
+def get_output_size(paths):
+    """Returns (number of tiles, bytes) of the given output files/trees."""
+    tiles = 0
+    size = 0
+    for path in paths:
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+            if path.endswith('.dzp'):
+                with tilepack.TilePackReader(path) as reader:
+                    tiles += len(reader)
+            continue
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                if name.endswith('.json'):
+                    continue
+                size += os.path.getsize(os.path.join(root, name))
+                tiles += 1
+    return tiles, size
+
+def run_image_creator(case, work_dir):
+    destination = os.path.join(work_dir, 'out.dzi')
+    creator = deepzoom.ImageCreator(tile_size=case['tile_size'], tile_format=case['format'],
+                                    workers=case['threads'], mipmap=case['mode'] == 'mipmap',
+                                    max_memory=case.get('max_memory'))
+    creator.create(case['source'], destination)
+    level_times = dict((level, stats['seconds'])
+                       for level, stats in creator.stats.levels.iteritems())
+    return level_times, [deepzoom._get_files_path(destination)], creator.stats.phases
+
+def run_pyramid_composer(case, work_dir):
+    from my_deepzoom_pdf import PyramidComposer
+    composer = PyramidComposer(image_path=case['source'], width=case['size'][0],
+                               height=case['size'][1], tile_size=case['tile_size'],
+                               overlap=1, min_level=0, max_level=0, format='png',
+                               filter=Image.ANTIALIAS, threads=case['threads'], page=1,
+                               holes=0, copy_tiles=0, max_memory=case.get('max_memory'))
+    composer.save(work_dir, 'out')
+    return composer.level_times, [os.path.join(work_dir, 'out1_files')], None
+
+def run_overlay_pyramid(case, work_dir):
+    from my_deepzoom_pdf import PyramidComposer
+    from my_deepzoom_overlay_png import OverlayPyramid
+    # the overlay is pasted onto a copy of a pyramid prepared beforehand
+    prefix = os.path.join(work_dir, 'out')
+    shutil.copytree(case['pyramid'], prefix + '_files')
+    width, height = case['size']
+    composer = PyramidComposer(image_path=None, width=width, height=height,
+                               tile_size=case['tile_size'], overlap=1, min_level=0,
+                               max_level=0, format='png', filter=Image.ANTIALIAS,
+                               threads=1, page=1, holes=0, copy_tiles=0)
+    overlay = OverlayPyramid(composer, threading.Semaphore(case['threads']), prefix,
+                             0.25, 0.25, Image.open(case['overlay']))
+    overlay.run()
+    return {}, [prefix + '_files'], None
+
+RUNNERS = {
+    'ImageCreator.create': run_image_creator,
+    'PyramidComposer.save': run_pyramid_composer,
+    'OverlayPyramid.run': run_overlay_pyramid,
+    }
+
+def run_case(case, result_path):
+    """Runs a single benchmark case (in a child process)."""
+    work_dir = tempfile.mkdtemp(prefix='benchmark-', dir=case['work_dir'])
+    # the tools report progress on stdout
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        start = time.time()
+        level_times, outputs, phases = RUNNERS[case['tool']](case, work_dir)
+        elapsed = time.time() - start
+        tiles, output_bytes = get_output_size(outputs)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    result = dict(case)
+    result.update({
+        'seconds': elapsed,
+        'tiles': tiles,
+        'tiles_per_sec': tiles / elapsed if elapsed else None,
+        'level_seconds': dict((str(level), seconds)
+                              for level, seconds in level_times.iteritems()),
+        'phase_seconds': phases,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'output_bytes': output_bytes,
+        })
+    with open(result_path, 'w') as f:
+        json.dump(result, f)
+
+def spawn_case(case):
+    """Runs a benchmark case in a new interpreter and returns its result."""
+    handle, result_path = tempfile.mkstemp(suffix='.json', dir=case['work_dir'])
+    os.close(handle)
+    try:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                               '--case', json.dumps(case), '--result', result_path])
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        os.remove(result_path)
+
+def get_case_key(result):
+    return (result['tool'], result.get('kind'), tuple(result['size']),
+            result['tile_size'], result['threads'], result.get('mode'))
+
+def compare(results, baseline_path):
+    """Prints tiles/sec and peak memory of the results against a baseline."""
+    with open(baseline_path) as f:
+        baseline = dict((get_case_key(result), result)
+                        for result in json.load(f)['results'])
+    for result in results:
+        old = baseline.get(get_case_key(result))
+        if old is None or not old['tiles_per_sec'] or not result['tiles_per_sec']:
+            continue
+        print '%-22s %-5s %-12s tile %-4s x%-3s %-7s %6.2fx speed %6.2fx memory' % (
+            result['tool'], result.get('kind', ''), '%sx%s' % tuple(result['size']),
+            result['tile_size'], result['threads'], result.get('mode', ''),
+            result['tiles_per_sec'] / old['tiles_per_sec'],
+            float(result['peak_rss_kb']) / old['peak_rss_kb'])
+
+def get_cases(options, work_dir):
+    """Generates the sources and yields all benchmark cases."""
+    sizes = [int(size) for size in options.sizes.split(',')]
+    tile_sizes = [int(tile_size) for tile_size in options.tile_sizes.split(',')]
+    threads = [int(count) for count in options.threads.split(',')]
+    modes = options.modes.split(',')
+    base = {'work_dir': work_dir}
+    for size in sizes:
+        dimensions = (size, size * 3 // 4)
+        for kind in SOURCE_KINDS:
+            source = os.path.join(work_dir, '%s_%s.png' % (kind, size))
+            if kind == 'noise':
+                make_noise_image(source, dimensions)
+            else:
+                make_flat_image(source, dimensions)
+            for tile_size in tile_sizes:
+                for count in threads:
+                    for mode in modes:
+                        case = dict(base, tool='ImageCreator.create', kind=kind,
+                                    source=source, size=dimensions,
+                                    tile_size=tile_size, threads=count,
+                                    mode=mode, format='jpg')
+                        if mode == 'bands':
+                            case['max_memory'] = options.max_memory
+                        yield case
+            if kind != 'flat':
+                continue
+            # overlays are pasted on PNG pyramids of the flat image
+            for tile_size in tile_sizes:
+                pyramid = os.path.join(work_dir, 'flat_%s_%s.dzi' % (size, tile_size))
+                deepzoom.ImageCreator(tile_size=tile_size, tile_format='png').create(
+                    source, pyramid)
+                overlay = os.path.join(work_dir, 'overlay_%s.png' % size)
+                make_flat_image(overlay, (size // 4, size // 4), seed=1)
+                yield dict(base, tool='OverlayPyramid.run', kind=kind, size=dimensions,
+                           tile_size=tile_size, threads=1, overlay=overlay,
+                           pyramid=deepzoom._get_files_path(pyramid))
+        if not find_executable('pdftoppm'):
+            continue
+        pdf = os.path.join(work_dir, 'vector_%s.pdf' % size)
+        # PDFs are rendered at 10 pixels per point, like my_deepzoom_pdf_all.sh
+        make_vector_pdf(pdf, options.pages, (size // 10, size * 3 // 40))
+        for tile_size in tile_sizes:
+            for count in threads:
+                # pages are rendered tile by tile or in bands, there's no mipmap mode
+                for mode in modes:
+                    if mode == 'mipmap':
+                        continue
+                    case = dict(base, tool='PyramidComposer.save', kind='pdf', source=pdf,
+                                size=dimensions, tile_size=tile_size, threads=count,
+                                mode=mode)
+                    if mode == 'bands':
+                        case['max_memory'] = options.max_memory
+                    yield case
+
+################################################################################
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options]')
+
+    parser.add_option('-o', '--output', dest='output',
+                      help='Write the results to this JSON file. Default: stdout')
+    parser.add_option('-c', '--compare', dest='compare',
+                      help='Compare the results with an earlier JSON result file.')
+    parser.add_option('-d', '--work-dir', dest='work_dir',
+                      help='Directory for sources and output. Default: a temporary directory')
+    parser.add_option('--sizes', dest='sizes', default='1024,4096',
+                      help='Comma separated source widths in pixels. Default: 1024,4096')
+    parser.add_option('--tile-sizes', dest='tile_sizes', default='254',
+                      help='Comma separated tile sizes. Default: 254')
+    parser.add_option('--threads', dest='threads', default='1,4',
+                      help='Comma separated thread/worker counts. Default: 1,4')
+    parser.add_option('--modes', dest='modes', default='default,mipmap,bands',
+                      help='Comma separated modes (default, mipmap, bands; PDFs have no mipmap mode). Default: all')
+    parser.add_option('--max-memory', dest='max_memory', type='int', default=64,
+                      help='Memory budget of the bands mode in megabytes. Default: 64')
+    parser.add_option('--pages', dest='pages', type='int', default=3,
+                      help='Number of pages of the generated PDFs. Default: 3')
+    parser.add_option('--case', dest='case', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--result', dest='result', help=optparse.SUPPRESS_HELP)
+
+    (options, args) = parser.parse_args()
+
+    if options.case:
+        run_case(json.loads(options.case), options.result)
+        return
+
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='deepzoom-benchmark-')
+    work_dir = os.path.abspath(deepzoom._get_or_create_path(work_dir))
+    results = []
+    try:
+        for case in get_cases(options, work_dir):
+            result = spawn_case(case)
+            results.append(result)
+            print >> sys.stderr, '%-22s %-5s %-10s tile %-4s x%-3s %-7s %7.2fs %9.1f tiles/s %7d KB' % (
+                result['tool'], result['kind'], '%sx%s' % tuple(result['size']),
+                result['tile_size'], result['threads'], result.get('mode', ''),
+                result['seconds'], result['tiles_per_sec'] or 0, result['peak_rss_kb'])
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': sys.version.split()[0],
+              'cpus': multiprocessing.cpu_count(),
+              'results': results}
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        print
+    if options.compare:
+        compare(results, options.compare)
+
+if __name__ == '__main__':
+    main()
@@ -36,10 +36,18 @@
 #  SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import functools
+import hashlib
+import heapq
+import httplib
+import itertools
+import json
 import math
+import multiprocessing
 import optparse
 import os
 import PIL.Image
+import re
 import shutil
 
 try:
@@ -48,13 +56,29 @@ try:
 except ImportError:
     import StringIO
 
+try:
+    import numpy
+except ImportError:
+    # only needed for the batch (array) versions of the tile geometry
+    numpy = None
+
+import socket
 import sys
+import tempfile
+import threading
 import time
 import urllib
+import urlparse
 import warnings
 import xml.dom.minidom
+import xml.sax.saxutils
+import xml.etree.cElementTree as ElementTree
 
-from collections import deque
+from array import array
+from collections import defaultdict, deque, OrderedDict
+from multiprocessing.pool import ThreadPool
+from multiprocessing.sharedctypes import RawArray
+from tilepack import TilePackWriter, get_pack_path, get_tile_format
 
 
 NS_DEEPZOOM = 'http://schemas.microsoft.com/deepzoom/2008'
@@ -63,6 +87,7 @@ DEFAULT_RESIZE_FILTER = PIL.Image.ANTIALIAS
 DEFAULT_IMAGE_FORMAT = 'jpg'
 
 RESIZE_FILTERS = {
+    'box': PIL.Image.BOX,
     'cubic': PIL.Image.CUBIC,
     'bilinear': PIL.Image.BILINEAR,
     'bicubic': PIL.Image.BICUBIC,
@@ -70,11 +95,43 @@ RESIZE_FILTERS = {
     'antialias': PIL.Image.ANTIALIAS,
     }
 
+# Tile formats and extensions of their files; 'auto' picks the smallest
+# of JPEG, PNG and palette PNG for every tile
 IMAGE_FORMATS = {
     'jpg': 'jpg',
     'png': 'png',
+    'webp': 'webp',
+    'webp-lossless': 'webp',
+    'auto': None,
+    }
+
+# Ways to store identical tiles once: hardlinks, or a _files/duplicates.json
+# the tiles are left out for. Viewers fetching tiles as static files don't
+# read that manifest, only deepzoom_server.py serves such pyramids.
+DEDUP_MODES = ('link', 'manifest')
+
+# Raw layouts used to share levels of these modes with worker processes
+SHARED_LAYOUTS = {
+    'L': 'L',
+    'RGB': 'RGBX',
+    'RGBA': 'RGBA',
+    'CMYK': 'CMYK',
     }
 
+# Rough memory footprint of a tile encoding worker process (in MB)
+WORKER_MEMORY = 16
+
+# Remote sources: threads fetching descriptors and tiles at once, timeout
+# of a request (in seconds) and size of a download kept in memory before
+# it's spooled to a temporary file (in bytes)
+FETCH_THREADS = 8
+HTTP_TIMEOUT = 60
+SPOOL_SIZE = 8 * 2**20
+MAX_REDIRECTS = 5
+
+# Number of parsed descriptors kept by open_descriptor
+DESCRIPTOR_CACHE_SIZE = 4096
+
 
 class DeepZoomImageDescriptor(object):
     def __init__(self, width=None, height=None,
@@ -84,22 +141,35 @@ class DeepZoomImageDescriptor(object):
         self.tile_size = tile_size
         self.tile_overlap = tile_overlap
         self.tile_format = tile_format
+        # formats of the tiles of levels mixing formats, row by row; tiles
+        # of other levels are all in tile_format
+        self.tile_formats = {}
         self._num_levels = None
 
     def open(self, source):
         """Intialize descriptor from an existing descriptor file."""
-        doc = xml.dom.minidom.parse(safe_open(source))
-        image = doc.getElementsByTagName('Image')[0]
-        size = doc.getElementsByTagName('Size')[0]
-        self.width = int(size.getAttribute('Width'))
-        self.height = int(size.getAttribute('Height'))
-        self.tile_size = int(image.getAttribute('TileSize'))
-        self.tile_overlap = int(image.getAttribute('Overlap'))
-        self.tile_format = image.getAttribute('Format')
+        image = ElementTree.parse(safe_open(source)).getroot()
+        size = _get_children(image, 'Size')[0]
+        self.width = int(size.get('Width'))
+        self.height = int(size.get('Height'))
+        self.tile_size = int(image.get('TileSize'))
+        self.tile_overlap = int(image.get('Overlap'))
+        self.tile_format = str(image.get('Format'))
+        self.tile_formats = {}
+        for formats in _get_children(image, 'TileFormats'):
+            names = formats.get('Formats').split()
+            for level in _get_children(formats, 'Level'):
+                self.tile_formats[int(level.get('Index'))] = \
+                    [names[int(i)] for i in (level.text or '').strip()]
 
     def save(self, destination):
         """Save descriptor file."""
         file = open(destination, 'w')
+        file.write(self.to_xml())
+        file.close()
+
+    def to_xml(self):
+        """Descriptor file contents."""
         doc = xml.dom.minidom.Document()
         image = doc.createElementNS(NS_DEEPZOOM, 'Image')
         image.setAttribute('xmlns', NS_DEEPZOOM)
@@ -110,10 +180,19 @@ class DeepZoomImageDescriptor(object):
         size.setAttribute('Width', str(self.width))
         size.setAttribute('Height', str(self.height))
         image.appendChild(size)
+        format_map = self.get_tile_format_map()
+        if format_map:
+            names, levels = format_map
+            formats = doc.createElementNS(NS_DEEPZOOM, 'TileFormats')
+            formats.setAttribute('Formats', ' '.join(names))
+            for level in sorted(levels):
+                level_formats = doc.createElementNS(NS_DEEPZOOM, 'Level')
+                level_formats.setAttribute('Index', str(level))
+                level_formats.appendChild(doc.createTextNode(levels[level]))
+                formats.appendChild(level_formats)
+            image.appendChild(formats)
         doc.appendChild(image)
-        descriptor = doc.toxml(encoding='UTF-8')
-        file.write(descriptor)
-        file.close()
+        return doc.toxml(encoding='UTF-8')
 
     @classmethod
     def remove(self, filename):
@@ -128,6 +207,36 @@ class DeepZoomImageDescriptor(object):
             self._num_levels = int(math.ceil(math.log(max_dimension, 2))) + 1
         return self._num_levels
 
+    def get_tile_format_map(self):
+        """Formats of the levels mixing them as (format names, {level: digits})
+        with a digit, the index of its format name, for every tile of a
+        level, row by row. None if all tiles are in tile_format."""
+        levels = [level for level, formats in self.tile_formats.iteritems()
+                  if any(f != self.tile_format for f in formats)]
+        if not levels:
+            return None
+        names = [self.tile_format] + sorted(
+            set(f for level in levels for f in self.tile_formats[level]) -
+            set([self.tile_format]))
+        indexes = dict((name, str(i)) for i, name in enumerate(names))
+        return names, dict((level, ''.join(indexes[f] for f in self.tile_formats[level]))
+                           for level in levels)
+
+    def get_tile_format(self, level, column, row):
+        """Format (file extension) of a tile."""
+        formats = self.tile_formats.get(level)
+        if formats is None:
+            return self.tile_format
+        columns, rows = self.get_num_tiles(level)
+        return formats[row * columns + column]
+
+    def set_tile_format(self, level, column, row, tile_format):
+        """Sets the format of a single tile."""
+        columns, rows = self.get_num_tiles(level)
+        if level not in self.tile_formats:
+            self.tile_formats[level] = [self.tile_format] * (columns * rows)
+        self.tile_formats[level][row * columns + column] = tile_format
+
     def get_scale(self, level):
         """Scale of a pyramid level."""
         assert 0 <= level and level < self.num_levels, 'Invalid pyramid level'
@@ -163,6 +272,24 @@ class DeepZoomImageDescriptor(object):
         h = min(h, level_height - y)
         return (x, y, x + w, y + h)
 
+    def get_level_dimensions(self):
+        """Dimensions of all levels as an array of (width, height) rows,
+        indexed by level."""
+        _require_numpy()
+        max_level = self.num_levels - 1
+        scales = numpy.ldexp(1.0, numpy.arange(-max_level, 1))
+        return numpy.ceil(numpy.outer(scales, (self.width, self.height))).astype(numpy.int64)
+
+    def get_level_tile_bounds(self, level):
+        """Bounding boxes of all tiles of a level as an array of shape
+        (columns, rows, 4), bounds[column, row] is the same as
+        get_tile_bounds(level, column, row)."""
+        assert 0 <= level and level < self.num_levels, 'Invalid pyramid level'
+        level_width, level_height = self.get_dimensions(level)
+        columns, rows = self.get_num_tiles(level)
+        return get_tile_bounds_array(columns, rows, level_width, level_height,
+                                      self.tile_size, self.tile_overlap)
+
 
 class DeepZoomCollection(object):
     def __init__(self, filename, image_quality=0.8, max_level=7,
@@ -172,41 +299,63 @@ class DeepZoomCollection(object):
         self.tile_size = tile_size
         self.max_level = max_level
         self.tile_format = tile_format
-        self.items = deque(items)
+        # items not saved yet
+        self.items = _ItemStore(items)
         self.next_item_id = len(self.items)
-        # XML
-        self.doc = xml.dom.minidom.Document()
-        collection = self.doc.createElementNS(NS_DEEPZOOM, 'Collection')
-        collection.setAttribute('xmlns', NS_DEEPZOOM)
-        collection.setAttribute('MaxLevel', str(self.max_level))
-        collection.setAttribute('TileSize', str(self.tile_size))
-        collection.setAttribute('Format', str(self.tile_format))
-        collection.setAttribute('Quality', str(self.image_quality))
-        items = self.doc.createElementNS(NS_DEEPZOOM, 'Items')
-        collection.appendChild(items)
-        collection.setAttribute('NextItemId', str(self.next_item_id))
-        self.doc.appendChild(collection)
+        # items already in the descriptor file, see from_file
+        self.incremental = False
 
     @classmethod
-    def from_file(self, filename):
-        """Open collection descriptor."""
-        doc = xml.dom.minidom.parse(safe_open(filename))
-        collection = doc.getElementsByTagName('Collection')[0]
-        image_quality = float(collection.getAttribute('Quality'))
-        max_level = int(collection.getAttribute('MaxLevel'))
-        tile_size = int(collection.getAttribute('TileSize'))
-        tile_format = collection.getAttribute('Format')
-        items = [DeepZoomCollectionItem.from_xml(item) for item
-                    in doc.getElementsByTagName('I')]
-
-        collection = DeepZoomCollection(filename,
-                                        image_quality=image_quality,
-                                        max_level=max_level,
-                                        tile_size=tile_size,
-                                        tile_format=tile_format,
-                                        items=items)
+    def from_file(self, filename, incremental=False):
+        """Open collection descriptor. In the incremental mode the items in
+        the file are taken as rendered and aren't loaded: save renders only
+        the items appended afterwards and adds them to the file."""
+        if incremental:
+            return self._from_file_header(filename)
+        collection = None
+        parent = None
+        for event, element in ElementTree.iterparse(safe_open(filename), ('start', 'end')):
+            tag = element.tag.rpartition('}')[2]
+            if event == 'start' and tag == 'Collection':
+                collection = self._from_attributes(filename, element.attrib)
+            elif event == 'start' and tag == 'Items':
+                parent = element
+            elif event == 'end' and tag == 'I':
+                collection.items.append(DeepZoomCollectionItem.from_element(element))
+                # drop parsed items right away
+                parent.clear()
+        collection.next_item_id = len(collection.items)
         return collection
 
+    @classmethod
+    def _from_attributes(self, filename, attributes):
+        return DeepZoomCollection(filename,
+                                  image_quality=float(attributes['Quality']),
+                                  max_level=int(attributes['MaxLevel']),
+                                  tile_size=int(attributes['TileSize']),
+                                  tile_format=attributes['Format'])
+
+    @classmethod
+    def _from_file_header(self, filename):
+        """Opens a collection descriptor for the incremental mode, reading
+        only what's needed to number new items."""
+        next_item_id = 0
+        attributes = None
+        for event, element in ElementTree.iterparse(safe_open(filename), ('start', 'end')):
+            tag = element.tag.rpartition('}')[2]
+            if event == 'start' and tag == 'Collection':
+                attributes = dict(element.attrib)
+                if attributes.get('NextItemId'):
+                    next_item_id = int(attributes['NextItemId'])
+                    break
+            elif event == 'end' and tag == 'I':
+                # no NextItemId, count the items
+                next_item_id = max(next_item_id, int(element.get('Id')) + 1)
+                element.clear()
+        collection = self._from_attributes(filename, attributes)
+        collection.next_item_id = next_item_id
+        collection.incremental = True
+        return collection
 
     @classmethod
     def remove(self, filename):
@@ -214,115 +363,177 @@ class DeepZoomCollection(object):
         _remove(filename)
 
     def append(self, source):
-        descriptor = DeepZoomImageDescriptor()
-        descriptor.open(source)
-        item = DeepZoomCollectionItem(source, descriptor.width, descriptor.height,
-                                     id=self.next_item_id)
-        self.items.append(item)
-        self.next_item_id += 1
-
-    def save(self, pretty_print_xml=False):
-        """Save collection descriptor."""
-        collection = self.doc.getElementsByTagName('Collection')[0]
-        items = self.doc.getElementsByTagName('Items')[0]
-        while len(self.items) > 0:
-            item = self.items.popleft()
-            i = self.doc.createElementNS(NS_DEEPZOOM, 'I')
-            i.setAttribute('Id', str(item.id))
-            i.setAttribute('N', str(item.id))
-            i.setAttribute('Source', item.source)
-            # Size
-            size = self.doc.createElementNS(NS_DEEPZOOM, 'Size')
-            size.setAttribute('Width', str(item.width))
-            size.setAttribute('Height', str(item.height))
-            i.appendChild(size)
-            items.appendChild(i)
-            self._append_image(item.source, item.id)
-        collection.setAttribute('NextItemId', str(self.next_item_id))
-        with open(self.source, 'w') as f:
-            if pretty_print_xml:
-                xml = self.doc.toprettyxml(encoding='UTF-8')
-            else:
-                xml = self.doc.toxml(encoding='UTF-8')
-            f.write(xml)
+        self.extend([source])
 
-    def _append_image(self, path, i):
-        descriptor = DeepZoomImageDescriptor()
-        descriptor.open(path)
-        files_path = _get_or_create_path(_get_files_path(self.source))
-        for level in reversed(xrange(self.max_level + 1)):
-            level_path = _get_or_create_path('%s/%s'%(files_path, level))
-            level_size = 2**level
-            images_per_tile = int(math.floor(self.tile_size / level_size))
-            column, row = self.get_tile_position(i, level, self.tile_size)
-            tile_path = '%s/%s_%s.%s'%(level_path, column, row, self.tile_format)
-            if not os.path.exists(tile_path):
-                tile_image = PIL.Image.new('RGB', (self.tile_size, self.tile_size))
-                q = int(self.image_quality * 100)
-                tile_image.save(tile_path, 'JPEG', quality=q)
-            tile_image = PIL.Image.open(tile_path)
-            source_path = '%s/%s/%s_%s.%s'%(_get_files_path(path), level, 0, 0,
-                                            descriptor.tile_format)
-            # Local
-            if os.path.exists(source_path):
-                try:
-                    source_image = PIL.Image.open(safe_open(source_path))
-                except IOError:
-                    warnings.warn('Skipped invalid level: %s' % source_path)
-                    continue
-            # Remote
+    def extend(self, sources):
+        """Appends several images, fetching their descriptors concurrently."""
+        for source, descriptor in zip(sources, open_descriptors(sources)):
+            item = DeepZoomCollectionItem(source, descriptor.width, descriptor.height,
+                                         id=self.next_item_id)
+            self.items.append(item)
+            self.next_item_id += 1
+
+    def save(self, pretty_print_xml=False, workers=1):
+        """Save collection descriptor and the tiles of its new items. Every
+        tile is composed in memory and encoded once; tiles of the largest
+        level are composed by several worker processes (or by threads,
+        fetching remote items concurrently, with a single worker). The
+        descriptor is written item by item, saving again only adds the
+        items appended since to the file."""
+        self._render_items(self.items, workers)
+        if self.incremental and os.path.exists(self.source):
+            self._append_to_file(self.items, pretty_print_xml)
+        else:
+            self._write_file(self.items, pretty_print_xml)
+        self.items.clear()
+        self.incremental = True
+
+    def _write_file(self, items, pretty_print_xml=False):
+        newl, indent = ('\n', '\t') if pretty_print_xml else ('', '')
+        attributes = {'xmlns': NS_DEEPZOOM,
+                      'MaxLevel': self.max_level,
+                      'TileSize': self.tile_size,
+                      'Format': self.tile_format,
+                      'Quality': self.image_quality,
+                      'NextItemId': self.next_item_id}
+        with open(self.source, 'wb') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>' + newl)
+            f.write('<Collection%s>%s' % (_format_xml_attributes(attributes), newl))
+            if not len(items):
+                f.write('%s<Items/>%s' % (indent, newl))
             else:
-                if level == self.max_level:
-                    try:
-                        source_image = PIL.Image.open(safe_open(source_path))
-                    except IOError:
-                        warnings.warn('Skipped invalid image: %s' % source_path)
-                        return
-                    # Expected width & height of the tile
-                    e_w, e_h = descriptor.get_dimensions(level)
-                    # Actual width & height of the tile
-                    w, h = source_image.size
-                    # Correct tile because of IIP bug where low-level tiles
-                    # have wrong dimensions (they are too large)
-                    if w != e_w or h != e_h:
-                        # Resize incorrect tile to correct size
-                        source_image = source_image.resize((e_w, e_h), PIL.Image.ANTIALIAS)
-                        # Store new dimensions
-                        w, h = e_w, e_h
+                f.write('%s<Items>%s' % (indent, newl))
+                for item in items:
+                    f.write(self._get_item_xml(item, pretty_print_xml))
+                f.write('%s</Items>%s' % (indent, newl))
+            f.write('</Collection>' + newl)
+
+    def _append_to_file(self, items, pretty_print_xml=False):
+        """Inserts items at the end of the descriptor file and updates its
+        NextItemId, copying everything else byte by byte."""
+        new_items = ''.join(self._get_item_xml(item, pretty_print_xml)
+                            for item in items)
+        temp_path = '%s.tmp' % self.source
+        with open(self.source, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 2**16))
+            tail_offset = f.tell()
+            tail = f.read()
+            end = tail.rfind('</Items>')
+            skip = 0
+            if end < 0:
+                # no items yet
+                end = tail.rfind('<Items/>')
+                if pretty_print_xml:
+                    new_items = '<Items>\n%s\t</Items>' % new_items
                 else:
-                    w = int(math.ceil(w * 0.5))
-                    h = int(math.ceil(h * 0.5))
-                    source_image.thumbnail((w, h), PIL.Image.ANTIALIAS)
-            column, row = self.get_position(i)
-            x = (column % images_per_tile) * level_size
-            y = (row % images_per_tile) * level_size
-            tile_image.paste(source_image, (x, y))
-            tile_image.save(tile_path)
+                    new_items = '<Items>%s</Items>' % new_items
+                skip = len('<Items/>')
+            elif pretty_print_xml:
+                # insert before the indentation of the end tag
+                end = len(tail[:end].rstrip(' \t'))
+            if end < 0:
+                raise IOError('No items found in %s' % self.source)
+            end += tail_offset
+            # the Collection start tag is at the start of the file
+            f.seek(0)
+            head = f.read(min(2**12, end))
+            head, count = re.subn(r'(<Collection\b[^>]*\bNextItemId=")\d*(")',
+                                  r'\g<1>%d\2' % self.next_item_id, head, 1)
+            if not count:
+                head = re.sub(r'(<Collection\b)', r'\1 NextItemId="%d"' % self.next_item_id,
+                              head, 1)
+            with open(temp_path, 'wb') as out:
+                out.write(head)
+                _copy_bytes(f, out, end - f.tell())
+                out.write(new_items)
+                f.seek(end + skip)
+                shutil.copyfileobj(f, out)
+        os.rename(temp_path, self.source)
+
+    def _get_item_xml(self, item, pretty_print_xml=False):
+        """XML of an item, laid out the way minidom writes it."""
+        i = _format_xml_attributes({'Id': item.id, 'N': item.id, 'Source': item.source})
+        size = _format_xml_attributes({'Width': item.width, 'Height': item.height})
+        if pretty_print_xml:
+            return '\t\t<I%s>\n\t\t\t<Size%s/>\n\t\t</I>\n' % (i, size)
+        return '<I%s><Size%s/></I>' % (i, size)
+
+    def _render_items(self, items, workers=1):
+        """Pastes the items into the collection tiles. Tiles of the largest
+        level are composed by the workers, in Z-order; smaller tiles are
+        composed here from the item images the workers return and written
+        as soon as all of their items are in."""
+        files_path = _get_or_create_path(_get_files_path(self.source))
+        for level in xrange(self.max_level + 1):
+            _get_or_create_path('%s/%s' % (files_path, level))
+        tiles = defaultdict(list)
+        # number of items every tile of the smaller levels waits for
+        pending = defaultdict(int)
+        for item in sorted(items, key=lambda item: item.id):
+            tiles[self.get_tile_position(item.id, self.max_level, self.tile_size)].append(item)
+            for level in xrange(self.max_level):
+                pending[(level,) + self.get_tile_position(item.id, level, self.tile_size)] += 1
+        positions = sorted(tiles, key=lambda position: self.get_z_order(*position))
+        tasks = [(self.get_collection_tile_path(self.max_level, *position),
+                  self.tile_size, self.tile_format, self.image_quality, self.max_level,
+                  [(item.id, item.source, self.get_item_offset(item.id, self.max_level))
+                   for item in tiles[position]])
+                 for position in positions]
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+        else:
+            pool = ThreadPool(FETCH_THREADS)
+        open_tiles = {}
+        try:
+            results = pool.imap(_render_collection_tile, tasks)
+            for position, (data, item_levels) in itertools.izip(positions, results):
+                with open(self.get_collection_tile_path(self.max_level, *position), 'wb') as f:
+                    f.write(data)
+                for item, levels in zip(tiles[position], item_levels):
+                    for level in xrange(self.max_level):
+                        key = (level,) + self.get_tile_position(item.id, level, self.tile_size)
+                        if level in levels:
+                            if key not in open_tiles:
+                                open_tiles[key] = _open_collection_tile(
+                                    self.get_collection_tile_path(*key), self.tile_size)
+                            open_tiles[key].paste(levels[level],
+                                                  self.get_item_offset(item.id, level))
+                        pending[key] -= 1
+                        if pending[key] == 0:
+                            del pending[key]
+                            self._write_collection_tile(key, open_tiles.pop(key, None))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _write_collection_tile(self, key, tile_image):
+        path = self.get_collection_tile_path(*key)
+        if tile_image is None:
+            # none of its items could be read
+            tile_image = _open_collection_tile(path, self.tile_size)
+        with open(path, 'wb') as f:
+            f.write(encode_tile(tile_image, self.tile_format, self.image_quality))
+
+    def get_collection_tile_path(self, level, column, row):
+        return '%s/%s/%s_%s.%s' % (_get_files_path(self.source), level, column, row,
+                                   self.tile_format)
+
+    def get_item_offset(self, z_order, level):
+        """Returns position (x, y) of an item in its tile of the given level."""
+        level_size = 2**level
+        images_per_tile = int(math.floor(self.tile_size / level_size))
+        column, row = self.get_position(z_order)
+        return ((column % images_per_tile) * level_size,
+                (row % images_per_tile) * level_size)
 
     def get_position(self, z_order):
         """Returns position (column, row) from given Z-order (Morton number.)"""
-        column = 0
-        row = 0
-        for i in xrange(0, 32, 2):
-            offset = i / 2
-            # column
-            column_offset = i
-            column_mask = 1 << column_offset
-            column_value = (z_order & column_mask) >> column_offset
-            column |= column_value << offset
-            #row
-            row_offset = i + 1
-            row_mask = 1 << row_offset
-            row_value = (z_order & row_mask) >> row_offset
-            row |= row_value << offset
-        return int(column), int(row)
+        return _compact_bits(z_order), _compact_bits(z_order >> 1)
 
     def get_z_order(self, column, row):
         """Returns the Z-order (Morton number) from given position."""
-        z_order = 0
-        for i in xrange(32):
-            z_order |= (column & 1 << i) << i | (row & 1 << i) << (i + 1)
-        return z_order
+        return _spread_bits(column) | _spread_bits(row) << 1
 
     def get_tile_position(self, z_order, level, tile_size):
         level_size = 2**level
@@ -330,8 +541,24 @@ class DeepZoomCollection(object):
         return (int(math.floor((x * level_size) / tile_size)),
                 int(math.floor((y * level_size) / tile_size)))
 
+    def get_positions(self, z_orders):
+        """Array version of get_position, returns arrays (columns, rows)."""
+        return morton_decode(z_orders)
+
+    def get_z_orders(self, columns, rows):
+        """Array version of get_z_order."""
+        return morton_encode(columns, rows)
+
+    def get_tile_positions(self, z_orders, level, tile_size):
+        """Array version of get_tile_position, returns arrays (columns, rows)."""
+        columns, rows = morton_decode(z_orders)
+        return ((columns.astype(numpy.int64) << level) // tile_size,
+                (rows.astype(numpy.int64) << level) // tile_size)
+
 
 class DeepZoomCollectionItem(object):
+    __slots__ = ('id', 'source', 'width', 'height')
+
     def __init__(self, source, width, height, id=0):
         self.id = id
         self.source = source
@@ -347,11 +574,49 @@ class DeepZoomCollectionItem(object):
         height = int(size.getAttribute('Height'))
         return DeepZoomCollectionItem(source, width, height, id)
 
+    @classmethod
+    def from_element(cls, element):
+        """Item from an ElementTree element."""
+        size = element[0]
+        return DeepZoomCollectionItem(element.get('Source'), int(size.get('Width')),
+                                      int(size.get('Height')), int(element.get('Id')))
+
+
+class _ItemStore(object):
+    """Collection items kept in arrays instead of one object per item;
+    iterating creates the item objects on the fly."""
+    def __init__(self, items=()):
+        self.ids = array('L')
+        self.widths = array('L')
+        self.heights = array('L')
+        self.sources = []
+        for item in items:
+            self.append(item)
+
+    def append(self, item):
+        self.ids.append(item.id)
+        self.widths.append(item.width)
+        self.heights.append(item.height)
+        self.sources.append(item.source)
+
+    def clear(self):
+        self.__init__()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for i in xrange(len(self.ids)):
+            yield DeepZoomCollectionItem(self.sources[i], self.widths[i],
+                                         self.heights[i], self.ids[i])
+
 
 class ImageCreator(object):
     """Creates Deep Zoom images."""
     def __init__(self, tile_size=254, tile_overlap=1, tile_format='jpg',
-                 image_quality=0.8, resize_filter=None, copy_metadata=False):
+                 image_quality=0.8, resize_filter=None, copy_metadata=False,
+                 mipmap=False, max_memory=None, workers=1, pack=False,
+                 dedup=None, progress=None, encoder=None):
         self.tile_size = int(tile_size)
         self.tile_format = tile_format
         self.tile_overlap = _clamp(int(tile_overlap), 0, 10)
@@ -360,6 +625,28 @@ class ImageCreator(object):
             self.tile_format = DEFAULT_IMAGE_FORMAT
         self.resize_filter = resize_filter
         self.copy_metadata = copy_metadata
+        self.mipmap = mipmap
+        self.mipmap_stats = []
+        self.max_memory = max_memory
+        self.workers = max(1, int(workers))
+        self.encoder = None
+        self.shared_encoder = encoder
+        self.pack = pack
+        self.tile_pack = None
+        self.image_files = None
+        if dedup is not None and dedup not in DEDUP_MODES:
+            raise ValueError('Unknown dedup mode: %s' % dedup)
+        self.dedup = dedup
+        self.dedup_stats = None
+        self.progress = progress
+        self.stats = None
+        self.skip_levels = frozenset()
+
+    def get_resize_filter(self):
+        """Returns the PIL filter used for resizing levels."""
+        if (self.resize_filter is None) or (self.resize_filter not in RESIZE_FILTERS):
+            return PIL.Image.ANTIALIAS
+        return RESIZE_FILTERS[self.resize_filter]
 
     def get_image(self, level):
         """Returns the bitmap image at the given level."""
@@ -368,9 +655,47 @@ class ImageCreator(object):
         # don't transform to what we already have
         if self.descriptor.width == width and self.descriptor.height == height:
             return self.image
-        if (self.resize_filter is None) or (self.resize_filter not in RESIZE_FILTERS):
-            return self.image.resize((width, height), PIL.Image.ANTIALIAS)
-        return self.image.resize((width, height), RESIZE_FILTERS[self.resize_filter])
+        start = time.time()
+        image = self.image.resize((width, height), self.get_resize_filter())
+        if self.stats:
+            self.stats.add_resample(level, start, time.time() - start)
+        return image
+
+    def levels(self):
+        """Iterator for all levels of the pyramid. Returns (level, image) of a level."""
+        if self.mipmap:
+            return self.mipmap_levels()
+        return ((level, self.get_image(level))
+                for level in xrange(self.descriptor.num_levels)
+                if level not in self.skip_levels)
+
+    def mipmap_levels(self):
+        """Iterator for all levels of the pyramid, from the largest to the
+        smallest one. Every level is reduced 2x from the level above it
+        instead of the full resolution image, and the level above is
+        released as soon as the caller asks for the next one."""
+        self.mipmap_stats = []
+        level_image = self.image
+        # the chain holds the only reference to the full resolution image
+        self.image = None
+        resize_filter = self.get_resize_filter()
+        full_resize_time = None
+        for level in reversed(xrange(self.descriptor.num_levels)):
+            width, height = self.descriptor.get_dimensions(level)
+            if level_image.size != (width, height):
+                start = time.time()
+                level_image = level_image.resize((width, height), resize_filter)
+                elapsed = time.time() - start
+                if self.stats:
+                    self.stats.add_resample(level, start, elapsed)
+                # resampling cost is dominated by the number of input pixels,
+                # so the first reduction (which reads the full resolution
+                # image) is what every level would cost without the chain
+                if full_resize_time is None:
+                    full_resize_time = elapsed
+                saved = max(0.0, full_resize_time - elapsed)
+                self.mipmap_stats.append((level, elapsed, saved))
+            yield level, level_image
 
     def tiles(self, level):
         """Iterator for all tiles in the given level. Returns (column, row) of a tile."""
@@ -379,34 +704,550 @@ class ImageCreator(object):
             for row in xrange(rows):
                 yield (column, row)
 
-    def create(self, source, destination):
-        """Creates Deep Zoom image from source file and saves it to destination."""
-        self.image = PIL.Image.open(safe_open(source))
+    def create(self, source, destination, skip_levels=()):
+        """Creates Deep Zoom image from source file and saves it to destination.
+        Tiles of levels in skip_levels are expected to exist already from an
+        interrupted run and aren't created again."""
+        if skip_levels and not self.can_skip_levels():
+            raise ValueError('Levels can\'t be skipped when packing, listing '
+                             'duplicates in a manifest or picking tile formats')
+        self.skip_levels = frozenset(skip_levels)
+        self.stats = ImageCreatorStats()
+        # with max_memory only the header is read here, bands are decoded
+        # on demand
+        self.image = open_image(source)
         width, height = self.image.size
         self.descriptor = DeepZoomImageDescriptor(width=width,
                                                   height=height,
                                                   tile_size=self.tile_size,
                                                   tile_overlap=self.tile_overlap,
-                                                  tile_format=self.tile_format)
+                                                  tile_format=IMAGE_FORMATS[self.tile_format] or 'jpg')
         # Create tiles
-        image_files = _get_or_create_path(_get_files_path(destination))
-        for level in xrange(self.descriptor.num_levels):
-            level_dir = _get_or_create_path(os.path.join(image_files, str(level)))
-            level_image = self.get_image(level)
-            for (column, row) in self.tiles(level):
-                bounds = self.descriptor.get_tile_bounds(level, column, row)
-                tile = level_image.crop(bounds)
-                format = self.descriptor.tile_format
-                tile_path = os.path.join(level_dir,
-                                         '%s_%s.%s'%(column, row, format))
-                tile_file = open(tile_path, 'wb')
-                if self.descriptor.tile_format == 'jpg':
-                    jpeg_quality = int(self.image_quality * 100)
-                    tile.save(tile_file, 'JPEG', quality=jpeg_quality)
-                else:
-                    tile.save(tile_file)
+        if self.dedup:
+            self.uniform_tiles = {}
+            self.tile_digests = {}
+            self.duplicates = {}
+            self.dedup_stats = {'tiles': 0, 'bytes': 0, 'encodes': 0, 'encode_time': 0.0}
+        if self.pack:
+            self.tile_pack = TilePackWriter(get_pack_path(destination))
+        else:
+            self.image_files = _get_or_create_path(_get_files_path(destination))
+        workers = self.get_workers()
+        if self.shared_encoder:
+            self.encoder = self.shared_encoder
+            self.encoder.adopt(self.tile_format, self.image_quality,
+                               self.tile_done)
+        elif workers > 1:
+            if self.max_memory:
+                # bands are too short-lived to share, tiles are sent instead
+                buffer_size = 0
+            else:
+                layout = SHARED_LAYOUTS.get(self.image.mode, '')
+                buffer_size = width * height * len(layout)
+            self.encoder = TileEncoder(workers, buffer_size,
+                                        self.tile_format,
+                                        self.image_quality, self.tile_done)
+        try:
+            if self.max_memory:
+                self.create_bands(source)
+            else:
+                start = time.time()
+                self.image.load()
+                self.stats.add('decode', time.time() - start)
+                for level, level_image in self.levels():
+                    if level in self.skip_levels:
+                        continue
+                    self.create_level_dir(level)
+                    if self.encoder:
+                        self.encoder.share(level_image)
+                    for (column, row) in self.tiles(level):
+                        bounds = self.descriptor.get_tile_bounds(level, column, row)
+                        self.save_tile(level_image, bounds, level, column, row)
+                    del level_image
+            if self.encoder:
+                self.encoder.join()
+            if self.dedup:
+                self.finish_dedup()
+            if self.tile_format == 'auto':
+                self.finish_formats()
+        finally:
+            if self.encoder and self.encoder is not self.shared_encoder:
+                self.encoder.close()
+            self.encoder = None
+            if self.tile_pack:
+                self.tile_pack.close()
+                self.tile_pack = None
         # Create descriptor
         self.descriptor.save(destination)
+        self.stats.finish()
+
+    def can_skip_levels(self):
+        """Whether create can leave out levels written before. Packs,
+        duplicate manifests and tile format maps can only be written
+        for the whole image."""
+        return not (self.pack or self.dedup == 'manifest' or self.tile_format == 'auto')
+
+    def create_level_dir(self, level):
+        """Creates the directory for tiles of the level (unless packing)."""
+        if self.image_files:
+            _get_or_create_path(os.path.join(self.image_files, str(level)))
+
+    def save_tile(self, image, bounds, level, column, row):
+        """Crops a tile from the image, encodes it and saves it. With several
+        workers it only gets queued for encoding."""
+        key = (level, column, row)
+        tile = None
+        uniform_key = None
+        if self.dedup:
+            # one-color tiles of the same size are encoded only once
+            tile = image.crop(bounds)
+            uniform_key = _get_uniform_key(tile)
+            uniform = self.uniform_tiles.get(uniform_key)
+            if uniform is not None:
+                uniform[1] += 1
+                self.dedup_stats['encodes'] += 1
+                if self.encoder:
+                    self.encoder.add(key, uniform[0], reused=True)
+                else:
+                    self.tile_done(key, uniform[0].get()[0], 0, 0)
+                return
+        if self.encoder:
+            result = self.encoder.submit(image, bounds, key)
+        else:
+            start = time.time()
+            if tile is None:
+                tile = image.crop(bounds)
+            crop_time = time.time() - start
+            start = time.time()
+            data = encode_tile(tile, self.tile_format, self.image_quality)
+            result = _EncodedTile(data, crop_time, time.time() - start)
+            self.tile_done(key, *result.get())
+        if uniform_key is not None:
+            self.uniform_tiles[uniform_key] = [result, 0]
+
+    def tile_done(self, key, data, crop_time, encode_time):
+        """Writes an encoded tile, updating the statistics and reporting
+        progress."""
+        level, column, row = key
+        start = time.time()
+        size = self.write_tile(level, column, row, data)
+        write_time = time.time() - start
+        stats = self.stats
+        stats.add('crop', crop_time)
+        stats.add('encode', encode_time)
+        stats.add('write', write_time)
+        columns, rows = self.descriptor.get_num_tiles(level)
+        done = stats.add_tile(level, column, row, columns * rows, size,
+                              crop_time + encode_time + write_time)
+        if self.progress:
+            self.progress(level, done, columns * rows)
+
+    def write_tile(self, level, column, row, data):
+        """Writes an encoded tile to its file or to the pack. Returns the
+        number of bytes written."""
+        if self.tile_format == 'auto':
+            self.descriptor.set_tile_format(level, column, row, get_tile_format(data))
+        if self.dedup:
+            digest = hashlib.sha1(data).digest()
+            original = self.tile_digests.get(digest)
+            if original is not None and self.link_tile((level, column, row), original):
+                self.dedup_stats['tiles'] += 1
+                self.dedup_stats['bytes'] += len(data)
+                return 0
+            self.tile_digests[digest] = (level, column, row)
+        if self.tile_pack:
+            self.tile_pack.write(level, column, row, data)
+            return len(data)
+        with open(self.get_tile_path(level, column, row), 'wb') as tile_file:
+            tile_file.write(data)
+        return len(data)
+
+    def get_tile_path(self, level, column, row):
+        return os.path.join(self.image_files, str(level), '%s_%s.%s'%(
+                            column, row, self.descriptor.get_tile_format(level, column, row)))
+
+    def link_tile(self, key, original):
+        """Makes the tile a reference to an identical one written before.
+        Returns False if it has to be written after all."""
+        if self.tile_pack:
+            self.tile_pack.link(key, original)
+            return True
+        if self.dedup == 'manifest':
+            self.duplicates['%s/%s_%s' % key] = '%s/%s_%s' % original
+            return True
+        tile_path = self.get_tile_path(*key)
+        if os.path.exists(tile_path):
+            os.remove(tile_path)
+        try:
+            os.link(self.get_tile_path(*original), tile_path)
+        except OSError:
+            # no hardlinks on this file system
+            return False
+        return True
+
+    def finish_formats(self):
+        """Makes the most common tile format the format of the descriptor,
+        so that only the other tiles are listed in its format map."""
+        counts = defaultdict(int)
+        for formats in self.descriptor.tile_formats.itervalues():
+            for tile_format in formats:
+                counts[tile_format] += 1
+        if counts:
+            self.descriptor.tile_format = max(counts, key=counts.get)
+
+    def finish_dedup(self):
+        """Writes the manifest of duplicated tiles and sums up savings. The
+        duplicates aren't written, so the pyramid has to be served by
+        deepzoom_server.py."""
+        for result, hits in self.uniform_tiles.itervalues():
+            self.dedup_stats['encode_time'] += hits * result.get()[2]
+        if self.dedup == 'manifest' and self.image_files:
+            manifest_path = os.path.join(self.image_files, 'duplicates.json')
+            with open(manifest_path, 'w') as manifest_file:
+                json.dump(self.duplicates, manifest_file, separators=(',', ':'),
+                          sort_keys=True)
+        self.uniform_tiles = self.tile_digests = self.duplicates = None
+
+    def get_workers(self):
+        """Number of tile encoding processes. In the streaming mode it's
+        limited to what fits in max_memory next to the smallest band. A
+        shared encoder brings its own processes."""
+        if self.shared_encoder:
+            return self.shared_encoder.workers
+        if not self.max_memory or self.workers == 1:
+            return self.workers
+        budget = self.max_memory * 2**20 - 5 * self.get_row_bytes()
+        return int(max(1, min(self.workers, budget // (WORKER_MEMORY * 2**20))))
+
+    def get_row_bytes(self):
+        """Size of a tile row (with overlap) of the full resolution image."""
+        bands = len(self.image.getbands())
+        return self.descriptor.width * bands * (self.tile_size + 2 * self.tile_overlap)
+
+    def get_band_rows(self):
+        """Number of tile rows of the full resolution image decoded at once
+        in the streaming mode, chosen to fit in max_memory megabytes next to
+        the worker processes."""
+        row_bytes = self.get_row_bytes()
+        budget = self.max_memory * 2**20
+        workers = self.get_workers()
+        if workers > 1:
+            budget -= workers * WORKER_MEMORY * 2**20
+        # every level keeps up to a tile row and a half of the band on top
+        # of the band itself, the smaller levels add up to as much again
+        band_rows = int((budget // row_bytes - 2) // 3)
+        if band_rows < 1:
+            warnings.warn('%s MB is not enough for a single tile row of %s'
+                          % (self.max_memory, self.descriptor.width))
+            return 1
+        return band_rows
+
+    def create_bands(self, source):
+        """Creates all tiles in a single pass over horizontal bands of the
+        source image. Every level holds only the rows needed for its next
+        tile row, the rows it is done with are reduced 2x and carried down
+        to the level below, so memory use doesn't depend on image height."""
+        num_levels = self.descriptor.num_levels
+        self.bands = [_LevelBand(self, level) for level in xrange(num_levels)]
+        width, height = self.image.size
+        band_height = self.get_band_rows() * self.tile_size
+        image = None
+        for top in xrange(0, height, band_height):
+            bottom = min(top + band_height, height)
+            band = None
+            start = time.time()
+            if image is None:
+                band = _read_image_rows(source, top, bottom)
+                if band is None:
+                    warnings.warn('%s can\'t be decoded in bands, '
+                                  'loading it whole' % source)
+                    image = self.image
+                    image.load()
+            if band is None:
+                band = image.crop((0, top, width, bottom))
+            self.stats.add('decode', time.time() - start)
+            if band.mode == 'P':
+                # new rows are pasted into fresh images, which have no palette
+                band = band.convert('RGBA' if 'transparency' in band.info else 'RGB')
+            elif band.mode == '1':
+                band = band.convert('L')
+            self.bands[num_levels - 1].push(band)
+        self.bands = None
+
+
+class _LevelBand(object):
+    """Rows of a pyramid level being tiled by ImageCreator.create_bands."""
+    def __init__(self, creator, level):
+        self.creator = creator
+        self.level = level
+        self.width, self.height = creator.descriptor.get_dimensions(level)
+        self.columns, self.rows = creator.descriptor.get_num_tiles(level)
+        # rows [top, bottom) of the level
+        self.image = None
+        self.top = 0
+        self.bottom = 0
+        # next tile row to save and number of rows passed to the level below
+        self.row = 0
+        self.reduced = 0
+        if level in creator.skip_levels:
+            # the rows are only carried down to the level below
+            self.row = self.rows
+        else:
+            creator.create_level_dir(level)
+
+    def push(self, image):
+        """Appends rows directly below the ones already held."""
+        self.image = append_rows(self.image, image)
+        self.bottom += image.size[1]
+        descriptor = self.creator.descriptor
+        while self.row < self.rows:
+            bounds = descriptor.get_tile_bounds(self.level, 0, self.row)
+            if bounds[3] > self.bottom:
+                break
+            for column in xrange(self.columns):
+                x1, y1, x2, y2 = descriptor.get_tile_bounds(self.level, column, self.row)
+                self.creator.save_tile(self.image, (x1, y1 - self.top, x2, y2 - self.top),
+                                       self.level, column, self.row)
+            self.row += 1
+        if self.level > 0:
+            count = self.bottom - self.reduced
+            if self.bottom < self.height:
+                # rows are reduced in pairs, the odd one waits for the next band
+                count -= count % 2
+            if count > 0:
+                start = self.reduced - self.top
+                rows = self.image.crop((0, start, self.width, start + count))
+                resample_start = time.time()
+                rows = reduce_half(rows)
+                self.creator.stats.add_resample(self.level - 1, resample_start,
+                                                time.time() - resample_start)
+                self.creator.bands[self.level - 1].push(rows)
+                self.reduced += count
+        if self.row < self.rows:
+            next_top = descriptor.get_tile_bounds(self.level, 0, self.row)[1]
+        else:
+            next_top = self.height
+        if self.level > 0:
+            next_top = min(next_top, self.reduced)
+        if next_top >= self.bottom:
+            self.image = None
+            self.top = self.bottom
+        elif next_top > self.top:
+            self.image = self.image.crop((0, next_top - self.top, self.width,
+                                          self.bottom - self.top))
+            self.top = next_top
+
+
+class TileEncoder(object):
+    """Encodes tiles in a pool of worker processes. The level being tiled is
+    copied once into shared memory, so only tile bounds and encoded tiles
+    travel between processes; tiles of other images are sent whole.
+    A single encoder can be passed to several ImageCreators in turn, e.g.
+    when converting a batch of images, with buffer_size fitting the largest
+    of them."""
+    def __init__(self, workers, buffer_size, tile_format, image_quality, done=None):
+        self.tile_format = tile_format
+        self.image_quality = image_quality
+        self.done = done
+        self.workers = workers
+        self.buffer = RawArray('c', max(1, buffer_size))
+        self.pool = multiprocessing.Pool(workers, _init_tile_worker, (self.buffer,))
+        # bounds the number of tiles (and their pixels) waiting in the queue
+        self.limit = 4 * workers
+        self.pending = deque()
+        self.shared = None
+        self.shared_spec = None
+
+    def adopt(self, tile_format, image_quality, done):
+        """Encodes the following tiles with the given settings and passes
+        them to another callback."""
+        self.join()
+        self.shared = None
+        self.tile_format = tile_format
+        self.image_quality = image_quality
+        self.done = done
+
+    def share(self, image):
+        """Makes the image available to the workers."""
+        self.join()
+        self.shared = None
+        layout = SHARED_LAYOUTS.get(image.mode)
+        width, height = image.size
+        if layout is None or width * height * len(layout) > len(self.buffer):
+            return
+        # the level is pasted straight into the shared memory, without an
+        # intermediate copy of its bytes
+        view = PIL.Image.frombuffer(layout, image.size, self.buffer,
+                                    'raw', layout, 0, 1)
+        view.readonly = 0
+        view.paste(image, (0, 0))
+        self.shared = image
+        self.shared_spec = (image.mode, layout, image.size)
+
+    def submit(self, image, bounds, key):
+        """Queues a tile for encoding, writing out the oldest encoded tiles
+        if too many are queued."""
+        if image is self.shared:
+            task = (self.shared_spec, bounds, None)
+        else:
+            tile = image.crop(bounds)
+            task = ((tile.mode, None, tile.size), None,
+                    (tile.tobytes(), tile.getpalette()))
+        task += (self.tile_format, self.image_quality)
+        result = self.pool.apply_async(_encode_tile_task, (task,))
+        self.add(key, result)
+        return result
+
+    def add(self, key, result, reused=False):
+        """Queues an already submitted tile to be written again under the key."""
+        self.pending.append((key, result, reused))
+        while len(self.pending) > self.limit:
+            self._write_next()
+
+    def join(self):
+        """Waits for all queued tiles and writes them out."""
+        while self.pending:
+            self._write_next()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def _write_next(self):
+        key, result, reused = self.pending.popleft()
+        data, crop_time, encode_time = result.get()
+        if reused:
+            crop_time = encode_time = 0
+        self.done(key, data, crop_time, encode_time)
+
+
+class _EncodedTile(object):
+    """A tile encoded in this process, with the result interface of tiles
+    encoded by TileEncoder workers."""
+    def __init__(self, data, crop_time, encode_time):
+        self.data = data
+        self.crop_time = crop_time
+        self.encode_time = encode_time
+
+    def get(self):
+        return self.data, self.crop_time, self.encode_time
+
+
+class ImageCreatorStats(object):
+    """Timings and counters of an ImageCreator.create run. Phase timers are
+    cumulative over all tiles, so with several workers they can add up to
+    more than the wall time."""
+    PHASES = ('decode', 'resample', 'crop', 'encode', 'write')
+
+    def __init__(self, slowest_tiles=10):
+        self.start = time.time()
+        self.seconds = None
+        self.phases = dict((phase, 0.0) for phase in self.PHASES)
+        self.levels = {}
+        self.max_slowest_tiles = slowest_tiles
+        # heap of (seconds, level, column, row)
+        self.slowest_tiles = []
+
+    def add(self, phase, seconds):
+        self.phases[phase] += seconds
+
+    def add_resample(self, level, start, seconds):
+        """Adds a resampling of the level that began at start."""
+        self.add('resample', seconds)
+        self.get_level(level, start)['resample'] += seconds
+
+    def get_level(self, level, start=None):
+        if level not in self.levels:
+            self.levels[level] = {'tiles': 0, 'bytes': 0, 'resample': 0.0,
+                                  'start': start or time.time(), 'seconds': 0.0}
+        return self.levels[level]
+
+    def add_tile(self, level, column, row, total, size, seconds):
+        """Counts a written tile, returns the number of tiles of the level
+        written so far."""
+        stats = self.get_level(level)
+        stats['tiles'] += 1
+        stats['total'] = total
+        stats['bytes'] += size
+        # from the start of the level (or of its resampling) until now
+        stats['seconds'] = time.time() - stats['start']
+        entry = (seconds, level, column, row)
+        if len(self.slowest_tiles) < self.max_slowest_tiles:
+            heapq.heappush(self.slowest_tiles, entry)
+        elif entry > self.slowest_tiles[0]:
+            heapq.heapreplace(self.slowest_tiles, entry)
+        return stats['tiles']
+
+    def finish(self):
+        self.seconds = time.time() - self.start
+
+    def to_dict(self):
+        """Returns the statistics as a dictionary, e.g. for JSON output."""
+        levels = {}
+        for level, stats in self.levels.iteritems():
+            levels[str(level)] = dict((key, value) for key, value in stats.iteritems()
+                                      if key != 'start')
+        return {'seconds': self.seconds,
+                'phases': self.phases,
+                'levels': levels,
+                'slowest_tiles': [{'level': level, 'column': column, 'row': row,
+                                   'seconds': seconds}
+                                  for seconds, level, column, row
+                                  in sorted(self.slowest_tiles, reverse=True)]}
+
+
+class LRUCache(object):
+    """Least recently used cache bounded by the total size of its values."""
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the cached value and marks it as recently used."""
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        """Caches the value, evicting the least recently used ones if the
+        cache gets too big. Values larger than the whole cache aren't kept."""
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self.size -= self.sizeof(self._items.pop(key))
+            if size > self.max_size:
+                return
+            self._items[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+    def stats(self):
+        """Returns a dictionary of cache counters."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'items': len(self._items), 'size': self.size,
+                    'max_size': self.max_size}
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+# Parsed descriptors shared by open_descriptor callers, bounded by count
+DESCRIPTOR_CACHE = LRUCache(DESCRIPTOR_CACHE_SIZE, sizeof=lambda descriptor: 1)
 
 
 class CollectionCreator(object):
@@ -433,30 +1274,314 @@ class CollectionCreator(object):
 
 ################################################################################
 
-def retry(attempts, backoff=2):
+def retry(attempts, backoff=2, delay=1, exceptions=(Exception,)):
     """Retries a function or method until it returns or
-    the number of attempts has been reached."""
+    the number of attempts has been reached. Waits delay seconds after the
+    first failure, backoff times longer after every next one."""
 
     if backoff <= 1:
         raise ValueError('backoff must be greater than 1')
 
     attempts = int(math.floor(attempts))
-    if attempts < 0:
-        raise ValueError('attempts must be 0 or greater')
+    if attempts < 1:
+        raise ValueError('attempts must be 1 or greater')
 
     def deco_retry(f):
+        @functools.wraps(f)
         def f_retry(*args, **kwargs):
-            last_exception = None
-            for _ in xrange(attempts):
+            for attempt in xrange(attempts):
                 try:
                     return f(*args, **kwargs)
-                except Exception as exception:
-                    last_exception = exception
-                    time.sleep(backoff**(attempts + 1))
-            raise last_exception
+                except exceptions:
+                    if attempt == attempts - 1:
+                        raise
+                    time.sleep(delay * backoff**attempt)
         return f_retry
     return deco_retry
 
+_shared_level = None
+
+def _init_tile_worker(buffer):
+    global _shared_level
+    _shared_level = buffer
+
+def _encode_tile_task(task):
+    (mode, layout, size), bounds, pixels, tile_format, image_quality = task
+    start = time.time()
+    if pixels is None:
+        level_image = PIL.Image.frombuffer(layout, size, _shared_level,
+                                           'raw', layout, 0, 1)
+        tile = level_image.crop(bounds)
+        if tile.mode != mode:
+            tile = tile.convert(mode)
+    else:
+        data, palette = pixels
+        tile = PIL.Image.frombytes(mode, size, data)
+        if palette:
+            tile.putpalette(palette)
+    crop_time = time.time() - start
+    start = time.time()
+    data = encode_tile(tile, tile_format, image_quality)
+    return data, crop_time, time.time() - start
+
+def _render_collection_tile(task):
+    """Composes a tile of the largest level of a collection from the items
+    on it. Returns the encoded tile and, for every item, a dictionary of its
+    images for the smaller levels."""
+    tile_path, tile_size, tile_format, image_quality, max_level, items = task
+    tile_image = _open_collection_tile(tile_path, tile_size)
+    item_levels = []
+    for id, source, offset in items:
+        levels = _get_collection_item_levels(source, max_level)
+        if max_level in levels:
+            tile_image.paste(levels.pop(max_level), offset)
+        item_levels.append(levels)
+    return encode_tile(tile_image, tile_format, image_quality), item_levels
+
+def _get_collection_item_levels(source, max_level):
+    """Returns images of a collection item for levels 0 to max_level, read
+    from the item's own tiles. Remote items only have their max_level tile
+    fetched, the smaller levels are scaled down from it."""
+    descriptor = DeepZoomImageDescriptor()
+    descriptor.open(source)
+    levels = {}
+    source_image = None
+    for level in reversed(xrange(max_level + 1)):
+        source_path = '%s/%s/%s_%s.%s'%(_get_files_path(source), level, 0, 0,
+                                        descriptor.tile_format)
+        # Local
+        if os.path.exists(source_path):
+            try:
+                source_image = PIL.Image.open(source_path)
+                source_image.load()
+            except IOError:
+                warnings.warn('Skipped invalid level: %s' % source_path)
+                continue
+            w, h = source_image.size
+        # Remote
+        elif level == max_level:
+            try:
+                source_image = PIL.Image.open(safe_open(source_path))
+                source_image.load()
+            except IOError:
+                warnings.warn('Skipped invalid image: %s' % source_path)
+                return levels
+            # Expected width & height of the tile
+            e_w, e_h = descriptor.get_dimensions(level)
+            # Actual width & height of the tile
+            w, h = source_image.size
+            # Correct tile because of IIP bug where low-level tiles
+            # have wrong dimensions (they are too large)
+            if w != e_w or h != e_h:
+                # Resize incorrect tile to correct size
+                source_image = source_image.resize((e_w, e_h), PIL.Image.ANTIALIAS)
+                # Store new dimensions
+                w, h = e_w, e_h
+        elif source_image is not None:
+            w = int(math.ceil(w * 0.5))
+            h = int(math.ceil(h * 0.5))
+            source_image = source_image.copy()
+            source_image.thumbnail((w, h), PIL.Image.ANTIALIAS)
+        else:
+            continue
+        levels[level] = source_image
+    return levels
+
+def _open_collection_tile(path, tile_size):
+    """Returns the collection tile written before or a new black one."""
+    if os.path.exists(path):
+        tile_image = PIL.Image.open(path)
+        tile_image.load()
+        return tile_image
+    return PIL.Image.new('RGB', (tile_size, tile_size))
+
+def _get_uniform_key(tile):
+    """Returns (mode, size, color) of a one-color tile or None."""
+    extrema = tile.getextrema()
+    if not isinstance(extrema[0], tuple):
+        extrema = (extrema,)
+    for low, high in extrema:
+        if low != high:
+            return None
+    return (tile.mode, tile.size, tuple(low for low, _ in extrema))
+
+def encode_tile(tile, tile_format, image_quality, png_options=None):
+    """Returns the tile encoded in the given format (see IMAGE_FORMATS).
+    png_options are passed to PIL's PNG encoder, e.g. compress_level and
+    compress_type (the zlib strategy)."""
+    if tile_format == 'auto':
+        return _encode_smallest(tile, image_quality)
+    tile_file = StringIO.StringIO()
+    if tile_format == 'jpg':
+        jpeg_quality = int(image_quality * 100)
+        tile.save(tile_file, 'JPEG', quality=jpeg_quality)
+    elif tile_format == 'webp':
+        tile.save(tile_file, 'WEBP', quality=int(image_quality * 100))
+    elif tile_format == 'webp-lossless':
+        tile.save(tile_file, 'WEBP', lossless=True)
+    else:
+        tile.save(tile_file, 'PNG', **(png_options or {}))
+    return tile_file.getvalue()
+
+def get_lossless_png_image(tile):
+    """Returns the RGB tile in the PNG color type taking the fewest bits per
+    pixel without changing any pixel: a palette image of 1, 2 or 4 bits for
+    up to 16 colors, grayscale for gray tiles, an 8 bit palette image for up
+    to 256 colors and the tile itself otherwise."""
+    if tile.mode != 'RGB':
+        return tile
+    colors = tile.getcolors(256)
+    if colors is not None and len(colors) <= 16:
+        palette_tile = _get_palette_image(tile, colors)
+        if palette_tile is not None:
+            return palette_tile
+    red, green, blue = tile.split()
+    if red.tobytes() == green.tobytes() == blue.tobytes():
+        return red
+    if colors is not None:
+        return _get_palette_image(tile, colors) or tile
+    return tile
+
+def _encode_smallest(tile, image_quality):
+    """Returns the smallest of the tile encoded as JPEG, PNG or palette
+    PNG. PNGs are only tried for tiles with few colors or transparency,
+    for other content JPEG is always smaller."""
+    candidates = []
+    has_alpha = 'A' in tile.getbands() or 'transparency' in tile.info
+    colors = tile.getcolors(256)
+    if colors is not None and tile.mode == 'RGB':
+        palette_tile = _get_palette_image(tile, colors)
+        if palette_tile is not None:
+            candidates.append(encode_tile(palette_tile, 'png', image_quality))
+    if colors is not None or has_alpha:
+        candidates.append(encode_tile(tile, 'png', image_quality))
+    if not has_alpha:
+        if tile.mode not in ('RGB', 'L', 'CMYK'):
+            tile = tile.convert('RGB')
+        candidates.append(encode_tile(tile, 'jpg', image_quality))
+    return min(candidates, key=len)
+
+def _get_palette_image(tile, colors):
+    """Returns the RGB tile as a palette image of its (up to 256) colors or
+    None if they can't be kept exactly."""
+    # median cut keeps every color when there are no more than requested
+    palette_tile = tile.quantize(len(colors))
+    # a palette of only the used colors lets PNG use fewer bits per pixel
+    palette_tile.putpalette(palette_tile.getpalette()[:3 * len(colors)])
+    if palette_tile.convert('RGB').tobytes() != tile.tobytes():
+        return None
+    return palette_tile
+
+def _format_xml_attributes(attributes):
+    """Attributes of an XML start tag, sorted by name like minidom does."""
+    values = []
+    for name in sorted(attributes):
+        value = attributes[name]
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        values.append(' %s="%s"' % (name, xml.sax.saxutils.escape(str(value), {'"': '&quot;'})))
+    return ''.join(values)
+
+def _get_children(element, name):
+    """Child elements with the given name in any (or no) namespace."""
+    return [child for child in element if child.tag.rpartition('}')[2] == name]
+
+def _copy_bytes(source, destination, length):
+    """Copies length bytes from one file to another."""
+    while length > 0:
+        chunk = source.read(min(length, 2**16))
+        if not chunk:
+            break
+        destination.write(chunk)
+        length -= len(chunk)
+
+# (shift, mask) steps spreading the 32 bits of a number to the even bits of
+# a 64 bit number (Morton numbers) and compacting them back
+_MORTON_SPREAD_STEPS = (
+    (16, 0x0000FFFF0000FFFF),
+    (8, 0x00FF00FF00FF00FF),
+    (4, 0x0F0F0F0F0F0F0F0F),
+    (2, 0x3333333333333333),
+    (1, 0x5555555555555555),
+    )
+_MORTON_COMPACT_STEPS = (
+    (1, 0x3333333333333333),
+    (2, 0x0F0F0F0F0F0F0F0F),
+    (4, 0x00FF00FF00FF00FF),
+    (8, 0x0000FFFF0000FFFF),
+    (16, 0x00000000FFFFFFFF),
+    )
+
+def _spread_bits(value):
+    value &= 0xFFFFFFFF
+    for shift, mask in _MORTON_SPREAD_STEPS:
+        value = (value | value << shift) & mask
+    return int(value)
+
+def _compact_bits(value):
+    value &= 0x5555555555555555
+    for shift, mask in _MORTON_COMPACT_STEPS:
+        value = (value | value >> shift) & mask
+    return int(value)
+
+def morton_encode(columns, rows):
+    """Z-orders (Morton numbers) of arrays of columns and rows (up to 32
+    bits each), returned as an uint64 array."""
+    _require_numpy()
+    columns = numpy.asarray(columns).astype(numpy.uint64)
+    rows = numpy.asarray(rows).astype(numpy.uint64)
+    return _spread_bits_array(columns) | _spread_bits_array(rows) << numpy.uint64(1)
+
+def morton_decode(z_orders):
+    """Columns and rows of an array of Z-orders (Morton numbers), returned
+    as two uint32 arrays."""
+    _require_numpy()
+    z_orders = numpy.asarray(z_orders).astype(numpy.uint64)
+    return (_compact_bits_array(z_orders),
+            _compact_bits_array(z_orders >> numpy.uint64(1)))
+
+def _spread_bits_array(values):
+    values = values & numpy.uint64(0xFFFFFFFF)
+    for shift, mask in _MORTON_SPREAD_STEPS:
+        values = (values | values << numpy.uint64(shift)) & numpy.uint64(mask)
+    return values
+
+def _compact_bits_array(values):
+    values = values & numpy.uint64(0x5555555555555555)
+    for shift, mask in _MORTON_COMPACT_STEPS:
+        values = (values | values >> numpy.uint64(shift)) & numpy.uint64(mask)
+    return values.astype(numpy.uint32)
+
+def get_tile_bounds_array(columns, rows, level_width, level_height,
+                           tile_size, tile_overlap):
+    """Bounds of a grid of tiles as an array of shape (columns, rows, 4);
+    the bounds along both axes are computed once and broadcast."""
+    _require_numpy()
+    x1, x2 = _get_axis_bounds(columns, level_width, tile_size, tile_overlap)
+    y1, y2 = _get_axis_bounds(rows, level_height, tile_size, tile_overlap)
+    bounds = numpy.empty((columns, rows, 4), dtype=x1.dtype)
+    bounds[..., 0] = x1[:, None]
+    bounds[..., 1] = y1[None, :]
+    bounds[..., 2] = x2[:, None]
+    bounds[..., 3] = y2[None, :]
+    return bounds
+
+def _get_axis_bounds(count, level_size, tile_size, tile_overlap):
+    start = numpy.arange(count, dtype=numpy.int64) * tile_size - tile_overlap
+    size = numpy.empty(count, dtype=numpy.int64)
+    size.fill(tile_size + 2 * tile_overlap)
+    if count:
+        # no overlap on the top and left edges
+        start[0] = 0
+        size[0] = tile_size + tile_overlap
+    # level_size may be a float (my_deepzoom_pdf), the bounds follow its type
+    size = numpy.minimum(size, level_size - start)
+    return start.astype(size.dtype), start + size
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError('numpy is required for the array versions of the tile geometry')
+
 def _get_or_create_path(path):
     if not os.path.exists(path):
         os.makedirs(path)
@@ -469,6 +1594,84 @@ def _clamp(val, min, max):
         return max
     return val
 
+def reduce_half(image):
+    """Reduces the image 2x by averaging 2x2 pixel blocks, repeating the last
+    column/row for odd sizes, so halves of an image reduce to the halves of
+    the reduced image."""
+    width, height = image.size
+    if width % 2 or height % 2:
+        padded = PIL.Image.new(image.mode, (width + width % 2, height + height % 2))
+        padded.paste(image, (0, 0))
+        if width % 2:
+            padded.paste(image.crop((width - 1, 0, width, height)), (width, 0))
+        if height % 2:
+            padded.paste(padded.crop((0, height - 1, width + width % 2, height)),
+                         (0, height))
+        image = padded
+    return image.resize((image.size[0] // 2, image.size[1] // 2), PIL.Image.BOX)
+
+def append_rows(image, rows):
+    if image is None:
+        return rows
+    width, height = image.size
+    joined = PIL.Image.new(image.mode, (width, height + rows.size[1]))
+    joined.paste(image, (0, 0))
+    joined.paste(rows, (0, height))
+    return joined
+
+def _read_image_rows(path, top, bottom):
+    """Decodes only rows [top, bottom) of a local image file. Works for
+    images stored in full width strips (uncompressed TIFF, PPM, BMP, ...),
+    returns None for other layouts. Compressed strips can't be cut and
+    would be decoded whole for every band (a JPEG or PNG is a single such
+    strip), so they are only read when the rows are the whole image."""
+    if not os.path.exists(path):
+        return None
+    image = PIL.Image.open(path)
+    width, height = image.size
+    if top == 0 and bottom == height:
+        image.load()
+        return image
+    tiles = []
+    for decoder, (x1, y1, x2, y2), offset, args in image.tile:
+        if x1 != 0 or x2 != width:
+            return None
+        if y2 <= top or y1 >= bottom:
+            continue
+        if decoder != 'raw':
+            return None
+        if y1 < top or y2 > bottom:
+            # raw strips can be cut at any row
+            if not isinstance(args, tuple):
+                args = (args,)
+            rawmode = args[0]
+            stride = args[1] if len(args) > 1 else 0
+            orientation = args[2] if len(args) > 2 else 1
+            if not stride:
+                if ';' in rawmode:
+                    return None
+                stride = width * len(rawmode)
+            cut_top, cut_bottom = max(y1, top), min(y2, bottom)
+            if orientation < 0:
+                offset += (y2 - cut_bottom) * stride
+            else:
+                offset += (cut_top - y1) * stride
+            y1, y2 = cut_top, cut_bottom
+            args = (rawmode, stride, orientation)
+        tiles.append((decoder, (x1, y1, x2, y2), offset, args))
+    if not tiles:
+        return None
+    # all strips now lie within the band
+    image.tile = [(decoder, (x1, y1 - top, x2, y2 - top), offset, args)
+                  for decoder, (x1, y1, x2, y2), offset, args in tiles]
+    size = (width, bottom - top)
+    if hasattr(image, '_size'):
+        image._size = size
+    else:
+        image.size = size
+    image.load()
+    return image
+
 def _get_files_path(path):
     return os.path.splitext(path)[0] + '_files'
 
@@ -477,9 +1680,162 @@ def _remove(path):
     tiles_path = _get_files_path(path)
     shutil.rmtree(tiles_path)
 
-@retry(6)
 def safe_open(path):
-    return StringIO.StringIO(urllib.urlopen(path).read())
+    """Returns a file object with the contents of a local path or URL.
+    Local files are opened directly, remote ones are streamed into a
+    temporary file (kept in memory while small)."""
+    scheme = urlparse.urlsplit(path).scheme
+    if scheme == 'file':
+        return open(urllib.url2pathname(urlparse.urlsplit(path).path), 'rb')
+    if len(scheme) <= 1:
+        # no scheme or a drive letter
+        return open(path, 'rb')
+    return _fetch(path)
+
+def open_image(path):
+    """Opens an image from a local path or URL. Local images are opened by
+    name, so that PIL can memory map uncompressed ones."""
+    if os.path.exists(path):
+        return PIL.Image.open(path)
+    return PIL.Image.open(safe_open(path))
+
+def open_descriptor(source, cache=DESCRIPTOR_CACHE):
+    """Returns the descriptor of a DZI file, parsed once and then taken from
+    the cache (as long as a local file doesn't change.) Cached descriptors
+    are shared, don't modify them."""
+    if cache is None:
+        descriptor = DeepZoomImageDescriptor()
+        descriptor.open(source)
+        return descriptor
+    key = _get_descriptor_key(source)
+    descriptor = cache.get(key)
+    if descriptor is None:
+        descriptor = open_descriptor(source, None)
+        cache.put(key, descriptor)
+    return descriptor
+
+def open_descriptors(sources, threads=FETCH_THREADS, cache=DESCRIPTOR_CACHE):
+    """Returns descriptors of the given DZI files, fetched concurrently."""
+    return _fetch_all(functools.partial(open_descriptor, cache=cache), sources, threads)
+
+def _get_descriptor_key(source):
+    scheme = urlparse.urlsplit(source).scheme
+    if scheme == 'file':
+        path = urllib.url2pathname(urlparse.urlsplit(source).path)
+    elif len(scheme) <= 1:
+        path = source
+    else:
+        return source
+    try:
+        stat = os.stat(path)
+    except OSError:
+        # reported by open
+        return source
+    return (os.path.abspath(path), stat.st_mtime, stat.st_size)
+
+def _fetch_all(function, args, threads=FETCH_THREADS):
+    """Maps the function over args in a pool of threads."""
+    if len(args) < 2:
+        return map(function, args)
+    pool = ThreadPool(min(threads, len(args)))
+    try:
+        return pool.map(function, args)
+    finally:
+        pool.close()
+
+
+class _ServerError(IOError):
+    """An HTTP error worth trying again."""
+
+
+class _ConnectionPool(object):
+    """Idle keep-alive HTTP connections by scheme and host."""
+    def __init__(self, max_idle=FETCH_THREADS):
+        self.max_idle = max_idle
+        self.idle = defaultdict(list)
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def get(self, scheme, host):
+        """Returns (connection, whether it was used before)."""
+        with self.lock:
+            if self.pid != os.getpid():
+                # connections inherited by a forked worker belong to the parent
+                self.idle = defaultdict(list)
+                self.pid = os.getpid()
+            if self.idle[(scheme, host)]:
+                return self.idle[(scheme, host)].pop(), True
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=HTTP_TIMEOUT), False
+        return httplib.HTTPConnection(host, timeout=HTTP_TIMEOUT), False
+
+    def put(self, scheme, host, connection):
+        with self.lock:
+            if len(self.idle[(scheme, host)]) < self.max_idle:
+                self.idle[(scheme, host)].append(connection)
+                return
+        connection.close()
+
+_connections = _ConnectionPool()
+
+@retry(6, exceptions=(_ServerError, httplib.HTTPException, socket.error))
+def _fetch(url):
+    """Downloads a URL into a spooled temporary file."""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    scheme = urlparse.urlsplit(url).scheme
+    if scheme not in ('http', 'https'):
+        shutil.copyfileobj(urllib.urlopen(url), spool)
+        spool.seek(0)
+        return spool
+    for _ in xrange(MAX_REDIRECTS + 1):
+        scheme, host, path, query, _ = urlparse.urlsplit(url)
+        response, connection = _request(scheme, host, urlparse.urlunsplit(
+                                        ('', '', path or '/', query, '')))
+        if response.status in (301, 302, 303, 307, 308):
+            url = urlparse.urljoin(url, response.getheader('Location'))
+            _finish(scheme, host, connection, response)
+            continue
+        if response.status != 200:
+            _finish(scheme, host, connection, response)
+            error = _ServerError if response.status >= 500 else IOError
+            raise error('HTTP %s %s: %s' % (response.status, response.reason, url))
+        _finish(scheme, host, connection, response, spool)
+        spool.seek(0)
+        return spool
+    raise IOError('Too many redirects: %s' % url)
+
+def _request(scheme, host, path):
+    """Sends a GET request over a pooled connection, returns the response
+    and the connection."""
+    while True:
+        connection, reused = _connections.get(scheme, host)
+        try:
+            connection.request('GET', path)
+            return connection.getresponse(), connection
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            # the server may have closed an idle connection in the meantime
+            if not reused:
+                raise
+
+def _finish(scheme, host, connection, response, destination=None):
+    """Reads the rest of the response (into destination) and returns the
+    connection to the pool if it can be reused."""
+    while True:
+        chunk = response.read(2**16)
+        if not chunk:
+            break
+        if destination is not None:
+            destination.write(chunk)
+    if response.will_close:
+        connection.close()
+    else:
+        _connections.put(scheme, host, connection)
+
+def _print_progress(level, done, total):
+    sys.stderr.write('\rlevel %s: %s/%s tiles' % (level, done, total))
+    if done == total:
+        sys.stderr.write('\n')
 
 ################################################################################
 
@@ -491,13 +1847,27 @@ def main():
     parser.add_option('-s', '--tile_size', dest='tile_size', type='int',
                       default=254, help='Size of the tiles. Default: 254')
     parser.add_option('-f', '--tile_format', dest='tile_format',
-                      default=DEFAULT_IMAGE_FORMAT, help='Image format of the tiles (jpg or png). Default: jpg')
+                      default=DEFAULT_IMAGE_FORMAT, help='Image format of the tiles (jpg, png, webp, webp-lossless or auto, the smallest of jpg, png and palette png for every tile). Default: jpg')
     parser.add_option('-o', '--tile_overlap', dest='tile_overlap', type='int',
                       default=1, help='Overlap of the tiles in pixels (0-10). Default: 1')
     parser.add_option('-q', '--image_quality', dest='image_quality', type='float',
                       default=0.8, help='Quality of the image output (0-1). Default: 0.8')
-    parser.add_option('-r', '--resize_filter', dest='resize_filter', default=DEFAULT_RESIZE_FILTER,
-                      help='Type of filter for resizing (bicubic, nearest, bilinear, antialias (best). Default: antialias')
+    parser.add_option('-r', '--resize_filter', dest='resize_filter', default='antialias',
+                      help='Type of filter for resizing (bicubic, nearest, bilinear, box, antialias (best). Default: antialias')
+    parser.add_option('-m', '--mipmap', dest='mipmap', action='store_true', default=False,
+                      help='Reduce every level from the level above it instead of the full image (faster, uses less memory).')
+    parser.add_option('--max-memory', dest='max_memory', type='int',
+                      help='Tile the image in horizontal bands fitting in the given number of megabytes.')
+    parser.add_option('-w', '--workers', dest='workers', type='int', default=1,
+                      help='Number of processes encoding tiles. Levels are shared with them in memory as large as the decoded image (except with --max-memory). Default: 1')
+    parser.add_option('-p', '--pack', dest='pack', action='store_true', default=False,
+                      help='Write all tiles into a single .dzp pack file instead of the _files directory.')
+    parser.add_option('--dedup', dest='dedup', choices=DEDUP_MODES,
+                      help='Write identical tiles once and hardlink the copies (link) or list them in _files/duplicates.json (manifest). Manifest output can only be served by deepzoom_server.py, use link for static hosting.')
+    parser.add_option('--progress', dest='progress', action='store_true', default=False,
+                      help='Report progress of every level on stderr.')
+    parser.add_option('--stats-json', dest='stats_json',
+                      help='Write timings of every phase and level to this JSON file.')
 
     (options, args) = parser.parse_args()
 
@@ -512,14 +1882,25 @@ def main():
             options.destination = os.path.splitext(source)[0] + '.dzi'
         else:
             options.destination = os.path.splitext(os.path.basename(source))[0] + '.dzi'
-    if options.resize_filter and options.resize_filter in RESIZE_FILTERS:
-        options.resize_filter = RESIZE_FILTERS[options.resize_filter]
 
     creator = ImageCreator(tile_size=options.tile_size,
                            tile_format=options.tile_format,
                            image_quality=options.image_quality,
-                           resize_filter=options.resize_filter)
+                           resize_filter=options.resize_filter,
+                           mipmap=options.mipmap,
+                           max_memory=options.max_memory,
+                           workers=options.workers,
+                           pack=options.pack,
+                           dedup=options.dedup,
+                           progress=_print_progress if options.progress else None)
     creator.create(source, options.destination)
+    if options.stats_json:
+        with open(options.stats_json, 'w') as f:
+            json.dump(creator.stats.to_dict(), f, indent=1, sort_keys=True)
+    if creator.dedup_stats:
+        print 'deduplicated %(tiles)s tiles (%(bytes)s bytes), skipped %(encodes)s encodes (~%(encode_time).2fs)' % creator.dedup_stats
+    for level, elapsed, saved in creator.mipmap_stats:
+        print 'level %s: reduced in %.2fs, ~%.2fs saved' % (level, elapsed, saved)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Batch Deep Zoom conversion
+
+Converts a whole catalog of images in a single process, all images sharing
+one pool of encoding workers. The images are either all images found in a
+directory or the ones listed in a manifest file, one path (or URL) per line,
+optionally followed by a tab and the name of the output:
+
+    paintings/autoportrety_2c.tif
+    paintings/pejzaze_1e.tif<TAB>pejzaze_1e
+
+Relative paths are relative to the manifest, empty lines and lines starting
+with # are ignored.
+
+Progress is recorded in a journal of JSON lines (by default journal.jsonl
+in the output directory): a record after every finished level and one
+after every finished pyramid. Running the same command again after an
+interruption skips the finished pyramids and only creates the missing
+levels of the one that was cut short. Records made with different tiling
+options are ignored.
+
+Usage:
+    deepzoom_batch.py [options] -d output_dir (directory | manifest)
+"""
+
+import hashlib
+import json
+import optparse
+import os
+import sys
+import time
+import traceback
+
+import deepzoom
+from deepzoom import ImageCreator, TileEncoder
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.gif',
+                    '.ppm', '.pgm', '.pbm')
+
+# ImageCreator options that change the tiles (and so invalidate the journal)
+TILING_OPTIONS = ('tile_size', 'tile_overlap', 'tile_format', 'image_quality',
+                  'resize_filter', 'mipmap', 'max_memory', 'pack', 'dedup')
+
+
+class Journal(object):
+    """Append-only log of finished levels and pyramids."""
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.levels = {}
+        self.done = set()
+        if os.path.exists(path):
+            self.load()
+        self.file = open(path, 'a')
+
+    def load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line of an interrupted run may be cut short
+                    continue
+                if record.get('settings') != self.settings:
+                    continue
+                destination = record['destination']
+                if record.get('done'):
+                    self.done.add(destination)
+                elif 'level' in record:
+                    self.levels.setdefault(destination, set()).add(record['level'])
+
+    def write(self, **record):
+        record['settings'] = self.settings
+        record['time'] = time.time()
+        self.file.write(json.dumps(record, sort_keys=True) + '\n')
+        self.file.flush()
+
+    def is_done(self, destination):
+        return destination in self.done and os.path.exists(destination)
+
+    def get_levels(self, destination):
+        """Levels of the pyramid finished so far."""
+        return self.levels.get(destination, set())
+
+    def close(self):
+        self.file.close()
+
+
+class BatchConverter(object):
+    """Converts a list of (source, destination) jobs with shared workers."""
+    def __init__(self, jobs, journal, workers=1, verbose=True, **options):
+        self.jobs = jobs
+        self.journal = journal
+        self.workers = max(1, int(workers))
+        self.verbose = verbose
+        self.options = options
+        self.failed = []
+
+    def run(self):
+        """Converts all jobs not finished yet. Returns the list of
+        (source, error) of failed jobs."""
+        jobs = [(source, destination) for source, destination in self.jobs
+                if not self.journal.is_done(destination)]
+        if self.verbose and len(jobs) < len(self.jobs):
+            print 'skipping %s finished images' % (len(self.jobs) - len(jobs))
+        encoder = None
+        if self.workers > 1 and jobs:
+            encoder = TileEncoder(self.workers, self.get_buffer_size(jobs),
+                                  self.options.get('tile_format', 'jpg'),
+                                  self.options.get('image_quality', 0.8))
+        try:
+            for i, (source, destination) in enumerate(jobs):
+                if self.verbose:
+                    print '[%s/%s] %s -> %s' % (i + 1, len(jobs), source, destination)
+                try:
+                    self.convert(source, destination, encoder)
+                except KeyboardInterrupt:
+                    raise
+                except Exception, e:
+                    traceback.print_exc()
+                    self.failed.append((source, str(e)))
+                    self.journal.write(destination=destination, error=str(e))
+        finally:
+            if encoder:
+                encoder.close()
+        return self.failed
+
+    def convert(self, source, destination, encoder):
+        def progress(level, done, total):
+            if done == total:
+                self.journal.write(destination=destination, level=level)
+
+        creator = ImageCreator(progress=progress, encoder=encoder, **self.options)
+        skip_levels = self.journal.get_levels(destination)
+        if not creator.can_skip_levels():
+            # the image is written again as a whole
+            skip_levels = ()
+        elif skip_levels and self.verbose:
+            print '    resuming, levels %s are done' % ', '.join(map(str, sorted(skip_levels)))
+        directory = os.path.dirname(destination)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        creator.create(source, destination, skip_levels=skip_levels)
+        self.journal.write(destination=destination, done=True,
+                           seconds=creator.stats.seconds)
+
+    def get_buffer_size(self, jobs):
+        """Shared memory needed for the largest level shared with the
+        workers (the band mode sends tiles instead). Remote sources aren't
+        downloaded just for their size, their tiles are sent to the workers
+        if they don't fit."""
+        if self.options.get('max_memory'):
+            return 0
+        size = 0
+        for source, destination in jobs:
+            if not os.path.exists(source):
+                continue
+            try:
+                image = deepzoom.open_image(source)
+            except Exception:
+                # reported when the image gets converted
+                continue
+            layout = deepzoom.SHARED_LAYOUTS.get(image.mode, '')
+            size = max(size, image.size[0] * image.size[1] * len(layout))
+        return size
+
+
+def get_settings(options):
+    """Short digest of the tiling options, stored with journal records."""
+    values = json.dumps([(name, options.get(name)) for name in TILING_OPTIONS])
+    return hashlib.sha1(values).hexdigest()[:12]
+
+def read_manifest(path):
+    """Returns (source, name) of all images listed in a manifest file."""
+    base = os.path.dirname(os.path.abspath(path))
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            source, _, name = line.partition('\t')
+            if '://' not in source:
+                source = os.path.join(base, source)
+            entries.append((source, name or None))
+    return entries
+
+def find_images(directory):
+    """Returns (source, None) of all images in a directory."""
+    return [(os.path.join(directory, name), None)
+            for name in sorted(os.listdir(directory))
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS]
+
+def get_jobs(entries, destination_dir):
+    """Returns (source, destination) pairs for manifest/directory entries."""
+    jobs = []
+    for source, name in entries:
+        if not name:
+            name = os.path.splitext(os.path.basename(source))[0]
+        jobs.append((source, os.path.join(destination_dir, name + '.dzi')))
+    return jobs
+
+################################################################################
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options] -d output_dir (directory | manifest)')
+
+    parser.add_option('-d', '--destination', dest='destination',
+                      help='Directory for the Deep Zoom images.')
+    parser.add_option('-j', '--journal', dest='journal',
+                      help='Journal of the conversion. Default: journal.jsonl in the destination directory')
+    parser.add_option('-s', '--tile_size', dest='tile_size', type='int',
+                      default=254, help='Size of the tiles. Default: 254')
+    parser.add_option('-f', '--tile_format', dest='tile_format',
+                      default=deepzoom.DEFAULT_IMAGE_FORMAT, help='Image format of the tiles (jpg, png, webp, webp-lossless or auto). Default: jpg')
+    parser.add_option('-o', '--tile_overlap', dest='tile_overlap', type='int',
+                      default=1, help='Overlap of the tiles in pixels (0-10). Default: 1')
+    parser.add_option('-q', '--image_quality', dest='image_quality', type='float',
+                      default=0.8, help='Quality of the image output (0-1). Default: 0.8')
+    parser.add_option('-r', '--resize_filter', dest='resize_filter', default='antialias',
+                      help='Type of filter for resizing (bicubic, nearest, bilinear, box, antialias (best). Default: antialias')
+    parser.add_option('-m', '--mipmap', dest='mipmap', action='store_true', default=False,
+                      help='Reduce every level from the level above it instead of the full image (faster, uses less memory).')
+    parser.add_option('--max-memory', dest='max_memory', type='int',
+                      help='Tile the images in horizontal bands fitting in the given number of megabytes.')
+    parser.add_option('-w', '--workers', dest='workers', type='int', default=1,
+                      help='Number of processes encoding tiles, shared by all images. Default: 1')
+    parser.add_option('-p', '--pack', dest='pack', action='store_true', default=False,
+                      help='Write the tiles of every image into a single .dzp pack file.')
+    parser.add_option('--dedup', dest='dedup', choices=deepzoom.DEDUP_MODES,
+                      help='Write identical tiles once and hardlink the copies (link) or list them in _files/duplicates.json (manifest). Manifest output can only be served by deepzoom_server.py, use link for static hosting.')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or not options.destination:
+        parser.print_help()
+        sys.exit(1)
+
+    if options.tile_format not in deepzoom.IMAGE_FORMATS:
+        options.tile_format = deepzoom.DEFAULT_IMAGE_FORMAT
+    if os.path.isdir(args[0]):
+        entries = find_images(args[0])
+    else:
+        entries = read_manifest(args[0])
+    if not os.path.exists(options.destination):
+        os.makedirs(options.destination)
+    jobs = get_jobs(entries, options.destination)
+
+    creator_options = dict((name, getattr(options, name)) for name in TILING_OPTIONS)
+    journal = Journal(options.journal or os.path.join(options.destination, 'journal.jsonl'),
+                      get_settings(creator_options))
+    try:
+        converter = BatchConverter(jobs, journal, workers=options.workers,
+                                   **creator_options)
+        failed = converter.run()
+    finally:
+        journal.close()
+    for source, error in failed:
+        print >> sys.stderr, 'failed: %s (%s)' % (source, error)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
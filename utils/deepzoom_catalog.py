@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Deep Zoom image catalog
+
+Scans a directory tree for .dzi files and writes the size and tiling of all
+of them into a single JSON file, so that a viewer can open the images
+without fetching their descriptors first. Images are keyed by their path
+relative to the scanned directory without the .dzi extension (the names
+sandbox/js/dzi_names_array.js lists), every entry holds the options
+Malakh.DziImage is built from:
+
+    {"pejzaze_1e":{"fileFormat":"jpg","height":3840,"tileOverlap":1,"tileSize":254,"width":5120},...}
+
+Levels mixing tile formats add a "tileFormats" entry, the <name>.sparse.json
+manifest of a sparse pyramid (see my_deepzoom_pdf.py) is included as its
+"sparse" entry. With --variable the
+catalog is written as a script assigning it to a global variable, to be
+loaded next to dzi_names_array.js.
+
+Usage:
+    deepzoom_catalog.py [options] -o catalog.json directory
+"""
+
+import json
+import multiprocessing
+import optparse
+import os
+import sys
+
+import deepzoom
+from deepzoom import DeepZoomImageDescriptor
+
+
+def find_descriptors(directory):
+    """Returns (name, path) of all .dzi files in a directory tree. Tile
+    directories (<name>_files) aren't searched."""
+    found = []
+    for path, dirs, files in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if not name.endswith('_files'))
+        for name in sorted(files):
+            if name.endswith('.dzi'):
+                file_path = os.path.join(path, name)
+                image_name = os.path.relpath(file_path, directory)[:-len('.dzi')]
+                found.append((image_name.replace(os.sep, '/'), file_path))
+    return found
+
+def get_entry(descriptor):
+    """Catalog entry of a descriptor."""
+    entry = {'width': descriptor.width,
+             'height': descriptor.height,
+             'tileSize': descriptor.tile_size,
+             'tileOverlap': descriptor.tile_overlap,
+             'fileFormat': descriptor.tile_format}
+    format_map = descriptor.get_tile_format_map()
+    if format_map:
+        names, levels = format_map
+        entry['tileFormats'] = {'formats': names,
+                                'levels': dict((str(level), digits)
+                                               for level, digits in levels.iteritems())}
+    return entry
+
+def get_descriptor(entry):
+    """Descriptor of a catalog entry."""
+    descriptor = DeepZoomImageDescriptor(width=entry['width'],
+                                         height=entry['height'],
+                                         tile_size=entry['tileSize'],
+                                         tile_overlap=entry['tileOverlap'],
+                                         tile_format=str(entry['fileFormat']))
+    tile_formats = entry.get('tileFormats')
+    if tile_formats:
+        names = [str(name) for name in tile_formats['formats']]
+        for level, digits in tile_formats['levels'].iteritems():
+            descriptor.tile_formats[int(level)] = [names[int(i)] for i in digits]
+    return descriptor
+
+def scan(directory, workers=1):
+    """Returns the catalog of a directory tree and the list of (path, error)
+    of descriptors that couldn't be read."""
+    found = find_descriptors(directory)
+    if workers > 1 and len(found) > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_read_entry, found, chunksize=64)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = map(_read_entry, found)
+    catalog = {}
+    failed = []
+    for (name, path), (entry, error) in zip(found, results):
+        if error:
+            failed.append((path, error))
+        else:
+            catalog[name] = entry
+    return catalog, failed
+
+def write_catalog(catalog, path, variable=None):
+    """Writes the catalog as compact JSON, or as a script assigning it to a
+    global variable."""
+    data = json.dumps(catalog, sort_keys=True, separators=(',', ':'))
+    with open(path, 'w') as f:
+        if variable:
+            f.write('this.%s = %s;\n' % (variable, data))
+        else:
+            f.write(data)
+
+def load_catalog(path):
+    """Returns descriptors of all images of a catalog file, by name."""
+    with open(path) as f:
+        catalog = json.load(f)
+    return dict((name, get_descriptor(entry)) for name, entry in catalog.iteritems())
+
+def get_sparse_path(path):
+    """Path of the sparse manifest belonging to a DZI file."""
+    return os.path.splitext(path)[0] + '.sparse.json'
+
+def _read_entry(task):
+    name, path = task
+    try:
+        entry = get_entry(deepzoom.open_descriptor(path, cache=None))
+        sparse_path = get_sparse_path(path)
+        if os.path.exists(sparse_path):
+            with open(sparse_path) as f:
+                entry['sparse'] = json.load(f)
+        return entry, None
+    except Exception, e:
+        return None, str(e)
+
+################################################################################
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options] -o catalog.json directory')
+
+    parser.add_option('-o', '--output', dest='output',
+                      help='Catalog file to write.')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+                      default=multiprocessing.cpu_count(),
+                      help='Number of processes reading descriptors. Default: number of CPUs')
+    parser.add_option('--variable', dest='variable',
+                      help='Write a script assigning the catalog to this global variable instead of JSON.')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or not options.output:
+        parser.print_help()
+        sys.exit(1)
+
+    catalog, failed = scan(args[0], options.workers)
+    write_catalog(catalog, options.output, options.variable)
+    print '%s images written to %s' % (len(catalog), options.output)
+    for path, error in failed:
+        print >> sys.stderr, 'failed: %s (%s)' % (path, error)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
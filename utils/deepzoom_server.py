@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Deep Zoom tile server
+
+Serves Deep Zoom images straight from their source images, rendering tiles
+only when a viewer asks for them. URLs follow the layout deepzoom.py writes
+to disk and Malakh.DziImage requests:
+
+    /<name>.dzi
+    /<name>_files/<level>/<column>_<row>.<format>
+
+Tiles are cut from decoded regions of a level (blocks of REGION_TILES x
+REGION_TILES tiles), both regions and encoded tiles are kept in size bounded
+LRU caches. With a cache directory rendered tiles are also written to disk
+and served from there later on. /_stats returns cache counters as JSON.
+
+Pyramids already written to disk are served by giving their .dzi files.
+Tiles missing from their _files directory are looked up in the
+duplicates.json of deepzoom.py --dedup manifest and in the subtrees.json of
+my_deepzoom_pdf.py --copy-mode map.
+
+Usage:
+    deepzoom_server.py [options] (image | image.dzi) [...]
+"""
+
+import json
+import optparse
+import os
+import re
+import sys
+import threading
+import PIL.Image
+
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer
+
+import deepzoom
+from deepzoom import DeepZoomImageDescriptor, LRUCache
+
+# Size of a decoded level region in tiles (in both directions)
+REGION_TILES = 8
+
+CONTENT_TYPES = {
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+    }
+
+TILE_URL = re.compile(r'^/(.+)_files/(\d+)/(\d+)_(\d+)\.(\w+)$')
+DZI_URL = re.compile(r'^/(.+)\.dzi$')
+
+
+class ImageSource(object):
+    """Renders tiles of a single source image."""
+    def __init__(self, path, tile_size=254, tile_overlap=1, tile_format='jpg',
+                 image_quality=0.8, resize_filter=None):
+        self.path = path
+        self.tile_format = tile_format
+        self.image_quality = image_quality
+        self.resize_filter = deepzoom.RESIZE_FILTERS.get(resize_filter,
+                                                         PIL.Image.ANTIALIAS)
+        self.image = deepzoom.open_image(path)
+        width, height = self.image.size
+        self.descriptor = DeepZoomImageDescriptor(width=width,
+                                                  height=height,
+                                                  tile_size=tile_size,
+                                                  tile_overlap=tile_overlap,
+                                                  tile_format=deepzoom.IMAGE_FORMATS[tile_format])
+        self._load_lock = threading.Lock()
+        self._loaded = False
+
+    def get_region_bounds(self, level, column, row):
+        """Bounding box (x1, y1, x2, y2) of the region holding the tile."""
+        descriptor = self.descriptor
+        size = REGION_TILES * descriptor.tile_size
+        level_width, level_height = descriptor.get_dimensions(level)
+        x = (column // REGION_TILES) * size
+        y = (row // REGION_TILES) * size
+        # regions overlap so that tiles on their edges can be cut from them
+        return (max(0, x - descriptor.tile_overlap),
+                max(0, y - descriptor.tile_overlap),
+                min(level_width, x + size + descriptor.tile_overlap),
+                min(level_height, y + size + descriptor.tile_overlap))
+
+    def render_region(self, level, bounds):
+        """Returns the region of the level scaled down from the source."""
+        with self._load_lock:
+            if not self._loaded:
+                self.image.load()
+                self._loaded = True
+        x1, y1, x2, y2 = bounds
+        scale = self.descriptor.get_scale(level)
+        if scale == 1:
+            return self.image.crop(bounds)
+        width, height = self.image.size
+        box = (x1 / scale, y1 / scale,
+               min(width, x2 / scale), min(height, y2 / scale))
+        return self.image.resize((x2 - x1, y2 - y1), self.resize_filter, box=box)
+
+
+class PyramidSource(object):
+    """Serves tiles of a pyramid written to disk."""
+    def __init__(self, path):
+        self.path = path
+        self.descriptor = deepzoom.open_descriptor(path)
+        self.tile_format = self.descriptor.tile_format
+        self.files = os.path.splitext(path)[0] + '_files'
+        # tiles listed as copies of other tiles, and roots of subtrees of
+        # tiles all showing the same as a single tile
+        self.duplicates = self.read_map('duplicates.json')
+        self.subtrees = self.read_map('subtrees.json')
+
+    def read_map(self, name):
+        """Returns {(level, column, row): (level, column, row)} of a tile map."""
+        path = os.path.join(self.files, name)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            entries = json.load(f)
+        return dict((_parse_tile_name(key), _parse_tile_name(value))
+                    for key, value in entries.iteritems())
+
+    def get_tile_path(self, level, column, row):
+        """Returns the path of the file holding the tile or None."""
+        path = self.get_file_path(level, column, row)
+        if os.path.exists(path):
+            return path
+        key = (level, column, row)
+        if key in self.duplicates:
+            return self.get_file_path(*self.duplicates[key])
+        for parent_level in xrange(level - 1, -1, -1):
+            column, row = column // 2, row // 2
+            root = self.subtrees.get((parent_level, column, row))
+            if root:
+                return self.get_file_path(*root)
+        return None
+
+    def get_file_path(self, level, column, row):
+        return os.path.join(self.files, str(level), '%s_%s.%s' % (
+                            column, row, self.descriptor.get_tile_format(level, column, row)))
+
+    def read_tile(self, level, column, row):
+        """Returns the bytes of a tile or None if there is no such tile."""
+        path = self.get_tile_path(level, column, row)
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+class TileServer(object):
+    """WSGI application serving tiles of the given sources."""
+    def __init__(self, sources, region_cache_size=256, tile_cache_size=64,
+                 cache_dir=None):
+        self.sources = sources
+        self.regions = LRUCache(region_cache_size * 2**20,
+                                sizeof=lambda image: image.size[0] * image.size[1] *
+                                                     len(image.getbands()))
+        self.tiles = LRUCache(tile_cache_size * 2**20)
+        self.cache_dir = cache_dir
+        self.disk_hits = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == '/_stats':
+            return self.respond(start_response, '200 OK', 'application/json',
+                                json.dumps(self.stats()))
+        match = DZI_URL.match(path)
+        if match and match.group(1) in self.sources:
+            descriptor = self.sources[match.group(1)].descriptor
+            return self.respond(start_response, '200 OK', 'application/xml',
+                                descriptor.to_xml())
+        match = TILE_URL.match(path)
+        if match:
+            name, level, column, row, format = match.groups()
+            data = self.get_tile(name, int(level), int(column), int(row), format)
+            if data is not None:
+                return self.respond(start_response, '200 OK', CONTENT_TYPES[format], data)
+        return self.respond(start_response, '404 Not Found', 'text/plain', 'Not Found')
+
+    def respond(self, start_response, status, content_type, body):
+        start_response(status, [('Content-Type', content_type),
+                                ('Content-Length', str(len(body)))])
+        return [body]
+
+    def get_tile(self, name, level, column, row, format):
+        """Returns the encoded tile or None if there is no such tile."""
+        source = self.sources.get(name)
+        if source is None:
+            return None
+        descriptor = source.descriptor
+        if not 0 <= level < descriptor.num_levels:
+            return None
+        columns, rows = descriptor.get_num_tiles(level)
+        if column >= columns or row >= rows:
+            return None
+        # pyramids on disk can mix formats (deepzoom.py -f auto)
+        if format != descriptor.get_tile_format(level, column, row):
+            return None
+        key = (name, level, column, row)
+        data = self.tiles.get(key)
+        if data is not None:
+            return data
+        if isinstance(source, PyramidSource):
+            data = source.read_tile(level, column, row)
+            if data is not None:
+                self.tiles.put(key, data)
+            return data
+        tile_path = self.get_tile_path(name, level, column, row, format)
+        if tile_path and os.path.exists(tile_path):
+            with open(tile_path, 'rb') as f:
+                data = f.read()
+            with self._lock:
+                self.disk_hits += 1
+        else:
+            data = self.render_tile(source, name, level, column, row)
+            if tile_path:
+                _write_atomically(tile_path, data)
+        self.tiles.put(key, data)
+        return data
+
+    def render_tile(self, source, name, level, column, row):
+        region_bounds = source.get_region_bounds(level, column, row)
+        region_key = (name, level) + region_bounds
+        region = self.regions.get(region_key)
+        if region is None:
+            region = source.render_region(level, region_bounds)
+            self.regions.put(region_key, region)
+        x1, y1, x2, y2 = source.descriptor.get_tile_bounds(level, column, row)
+        rx, ry = region_bounds[:2]
+        tile = region.crop((x1 - rx, y1 - ry, x2 - rx, y2 - ry))
+        return deepzoom.encode_tile(tile, source.tile_format, source.image_quality)
+
+    def get_tile_path(self, name, level, column, row, format):
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, '%s_files' % name, str(level),
+                            '%s_%s.%s' % (column, row, format))
+
+    def stats(self):
+        with self._lock:
+            disk_hits = self.disk_hits
+        return {'tiles': self.tiles.stats(),
+                'regions': self.regions.stats(),
+                'disk_hits': disk_hits}
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def _parse_tile_name(name):
+    """(level, column, row) of a "level/column_row" tile name."""
+    level, _, position = name.partition('/')
+    column, _, row = position.partition('_')
+    return int(level), int(column), int(row)
+
+def _write_atomically(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created by another thread in the meantime
+            pass
+    temp_path = '%s.%s.tmp' % (path, threading.current_thread().ident)
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.rename(temp_path, path)
+
+################################################################################
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options] (image | image.dzi) [...]')
+
+    parser.add_option('-H', '--host', dest='host', default='127.0.0.1',
+                      help='Address to listen on. Default: 127.0.0.1')
+    parser.add_option('-P', '--port', dest='port', type='int', default=8000,
+                      help='Port to listen on. Default: 8000')
+    parser.add_option('-s', '--tile_size', dest='tile_size', type='int',
+                      default=254, help='Size of the tiles. Default: 254')
+    parser.add_option('-f', '--tile_format', dest='tile_format',
+                      default=deepzoom.DEFAULT_IMAGE_FORMAT, help='Image format of the tiles (jpg, png, webp or webp-lossless). Default: jpg')
+    parser.add_option('-o', '--tile_overlap', dest='tile_overlap', type='int',
+                      default=1, help='Overlap of the tiles in pixels (0-10). Default: 1')
+    parser.add_option('-q', '--image_quality', dest='image_quality', type='float',
+                      default=0.8, help='Quality of the image output (0-1). Default: 0.8')
+    parser.add_option('-r', '--resize_filter', dest='resize_filter', default='antialias',
+                      help='Type of filter for resizing (bicubic, nearest, bilinear, box, antialias (best). Default: antialias')
+    parser.add_option('--region-cache', dest='region_cache', type='int', default=256,
+                      help='Size of the decoded region cache in megabytes. Default: 256')
+    parser.add_option('--tile-cache', dest='tile_cache', type='int', default=64,
+                      help='Size of the encoded tile cache in megabytes. Default: 64')
+    parser.add_option('-c', '--cache-dir', dest='cache_dir',
+                      help='Write rendered tiles to (and serve them from) this directory.')
+
+    (options, args) = parser.parse_args()
+
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+
+    # tiles are rendered on request, so their format has to be known upfront
+    if not deepzoom.IMAGE_FORMATS.get(options.tile_format):
+        options.tile_format = deepzoom.DEFAULT_IMAGE_FORMAT
+    sources = {}
+    for path in args:
+        name = os.path.splitext(os.path.basename(path))[0]
+        if path.endswith('.dzi'):
+            sources[name] = PyramidSource(path)
+            continue
+        sources[name] = ImageSource(path, tile_size=options.tile_size,
+                                    tile_overlap=options.tile_overlap,
+                                    tile_format=options.tile_format,
+                                    image_quality=options.image_quality,
+                                    resize_filter=options.resize_filter)
+    app = TileServer(sources, region_cache_size=options.region_cache,
+                     tile_cache_size=options.tile_cache,
+                     cache_dir=options.cache_dir)
+    server = make_server(options.host, options.port, app,
+                         server_class=ThreadingWSGIServer)
+    print 'Serving %s on http://%s:%s/' % (', '.join(sorted(sources)),
+                                           options.host, options.port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,7 @@ import re
 import threading
 import shutil
 from PIL import Image
-from my_seadragon_pdf import PyramidComposer
+from my_deepzoom_pdf import PyramidComposer
 
 class OverlayPyramid(object):
     def __init__( self, composer, threads_semaphore, path_prefix, png_x, png_y, png_img ):
@@ -26,10 +26,10 @@ class OverlayPyramid(object):
             thread.join()
 
     def getPngBoxAtLevel(self, level):
-        png_x = int(self.png_x * self.composer.width / (2 ** (self.composer.levels - level)))
-        png_y = int(self.png_y * self.composer.width / (2 ** (self.composer.levels - level)))
-        png_w = int(self.png_w / (2 ** (self.composer.levels - level)))
-        png_h = int(self.png_h / (2 ** (self.composer.levels - level)))
+        png_x = int(self.png_x * self.composer.width / (2 ** (self.composer.max_level - level)))
+        png_y = int(self.png_y * self.composer.width / (2 ** (self.composer.max_level - level)))
+        png_w = max(1, int(self.png_w / (2 ** (self.composer.max_level - level))))
+        png_h = max(1, int(self.png_h / (2 ** (self.composer.max_level - level))))
         return (png_x, png_y, png_w, png_h)
 
     def getPathToTile(self, level, col, row):
@@ -53,9 +53,7 @@ class OverlayPyramid(object):
                 tile_anc_y = 1
             tile_anc = Image.open(tile_path_anc)
             oldW, oldH = tile_anc.size
-            tile_anc.save('/home/mgol/Documents/projects/labee/tile_anc.png')
             tile_anc_doubled = tile_anc.resize((2 * oldW, 2 * oldH), Image.ANTIALIAS)
-            tile_anc_doubled.save('/home/mgol/Documents/projects/labee/tile_anc_doubled.png')
             tile_anc_cropped = tile_anc_doubled.crop((tile_anc_x * oldW, tile_anc_y * oldH, (1 + tile_anc_x) * oldW, (1 + tile_anc_y) * oldH),)
             tile_anc_cropped.save(tile_path)
 
@@ -120,7 +118,7 @@ class OverlayPyramid(object):
         # we have to do it from the highest levels because we copy
         # ancestor tiles if current one doesn't exist and it would
         # interfere in this process
-        for level_str in range(self.composer.levels, 0, -1):
+        for level_str in range(self.composer.max_level, 0, -1):
             level = int(level_str)
             col_min, col_max, row_min, row_max = self.getColsRows(level)
             png_x, png_y, png_w, png_h = self.getPngBoxAtLevel(level)
@@ -152,6 +150,7 @@ def main():
     parser.add_option('-y', '--top',  dest = "png_y", type="float", default=0, help = 'Overlay distance from the top')
     parser.add_option('-s', '--tile-size', dest = "size", type="int",
                       default=256, help = 'The tile height/width')
+    parser.add_option('--overlap', dest = "overlap", type="int", default=1, help = 'How much tiles are overlapping')
     parser.add_option('-f', '--format', dest="format",
                       default="png", help = 'Set the Image Format (jpg or png)')
     parser.add_option('-j', '--threads', dest = "threads", type = "int", default = 1, # broken when multi-threaded so far
@@ -172,7 +171,8 @@ def main():
     dzi_height = int(dzi_dom_size.getAttribute('Height'))
 
     threads_semaphore = threading.Semaphore(options.threads)
-    composer = PyramidComposer(image_path=None, width=dzi_width, height=dzi_height, tile_size=options.size, format=options.format, filter=options.transform, threads=1)
+    composer = PyramidComposer(image_path=None, width=dzi_width, height=dzi_height, tile_size=options.size, overlap=options.overlap,
+            min_level=0, max_level=0, format=options.format, filter=options.transform, threads=1, page=1, holes=0, copy_tiles=0)
     overlay = OverlayPyramid(composer, threads_semaphore, path_prefix, options.png_x, options.png_y, png_img)
     overlay.run()
 
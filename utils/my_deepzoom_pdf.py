@@ -48,11 +48,20 @@ Date: 11/29/2008
 License: BSD
 """
 
-import math, os, optparse, sys
+import math, os, optparse, sys, time
 from PIL import Image
+from collections import OrderedDict
+from cStringIO import StringIO
+import hashlib
+import json
+import Queue
 import subprocess
 import threading
+import traceback
 import shutil
+import zlib
+import tilepack
+import deepzoom
 
 xml_template = '''\
 <?xml version="1.0" encoding="UTF-8"?>
@@ -63,6 +72,26 @@ xml_template = '''\
 '''
 
 
+# quality of jpg tiles (0-1)
+IMAGE_QUALITY = 0.8
+
+# default size of the render cache in megabytes
+RENDER_CACHE_SIZE = 1024
+
+# how one-color tiles reach their children: written to every child (copy),
+# hardlinked to the first tile of the same content (link) or left out and
+# listed in _files/subtrees.json (map)
+COPY_MODES = ('copy', 'link', 'map')
+
+# zlib strategies of PNG tiles (Python 2's zlib lacks Z_RLE and Z_FIXED)
+PNG_STRATEGIES = {
+    'default' : 0,
+    'filtered' : 1,
+    'huffman' : 2,
+    'rle' : 3,
+    'fixed' : 4,
+    }
+
 filter_map = {
     'cubic' : Image.CUBIC,
     'bilinear' : Image.BILINEAR,
@@ -73,7 +102,7 @@ filter_map = {
 
 
 class PyramidComposer( object ):
-    def __init__( self, image_path, width, height, tile_size, overlap, min_level, max_level, format, filter, threads, page, holes, copy_tiles ):
+    def __init__( self, image_path, width, height, tile_size, overlap, min_level, max_level, format, filter, threads, page, holes, copy_tiles, pack=False, max_memory=None, uniform_tolerance=0, render_cache=None, copy_mode='copy', render_levels=0, png_colors=False, png_compress_level=None, png_strategy=None, png_savings=False ):
         self.image_path = image_path
         self.width = width
         self.height = height
@@ -88,9 +117,43 @@ class PyramidComposer( object ):
         self.filter = filter
         self.page = page
         self.dont_create_lock = threading.Lock()
-        self.threads_semaphore = threading.Semaphore(threads)
+        self.threads = threads
         self.holes = holes
         self.copy_tiles = copy_tiles
+        self.copy_mode = copy_mode in COPY_MODES and copy_mode or 'copy'
+        # path of the first tile written of every one-color tile content (link mode)
+        self.uniform_files = {}
+        # (level, col, row) of the first tile of every one-color tile content,
+        # that tile and the color for the roots of one-color subtrees
+        self.uniform_roots = {}
+        self.subtrees = {}
+        self.subtree_colors = {}
+        self.copied_tiles = 0
+        # tiles with all bands varying by at most this much count as one-color
+        self.uniform_tolerance = uniform_tolerance
+        # encoded one-color tiles by (mode, size, color)
+        self.uniform_tiles = {}
+        self.pack = pack
+        # render tile rows in bands fitting in max_memory megabytes (for all threads)
+        self.max_memory = max_memory
+        # render only this many of the deepest levels from the PDF, the others
+        # are reduced from the level below them (0 renders all levels)
+        self.render_levels = render_levels
+        self.reduce_time = 0
+        # write png tiles in the smallest lossless color type, see deepzoom.get_lossless_png_image
+        self.png_colors = png_colors
+        self.png_options = {}
+        if png_compress_level is not None:
+            self.png_options['compress_level'] = png_compress_level
+        if png_strategy:
+            self.png_options['compress_type'] = PNG_STRATEGIES[png_strategy]
+        # also encode every reduced tile as RGB to measure the savings
+        self.png_savings = png_savings
+        self.png_stats = {'gray': 0, '1-bit': 0, 'palette': 0, 'rgb': 0, 'bytes': 0, 'rgb_bytes': 0}
+        # RenderCache of rendered regions (may be shared by several composers)
+        self.render_cache = render_cache
+        self.level_times = {}
+        self.worker_stats = []
 
     @property
     def max_level( self ):
@@ -143,6 +206,13 @@ class PyramidComposer( object ):
 
         return px, py, px+sx, py+sy
 
+    def getLevelTileBoxes( self, level ):
+        """ return bounding boxes of all tiles of a level as an array of shape
+        (columns, rows, 4), boxes[column, row] equals getTileBox( level, column, row )"""
+        dsw, dsh = self.getLevelDimensions( level )
+        col, row = self.getLevelRowCol( level )
+        return deepzoom.get_tile_bounds_array( int( col ), int( row ), dsw, dsh, self.tile_size, self.overlap )
+
     def iterTiles( self, level ):
         col, row = self.getLevelRowCol( level )
         for w in range( 0, int( col ) ):
@@ -162,84 +232,393 @@ class PyramidComposer( object ):
         str_tile_path = str_tile_path_prefix + '.' + self.format
 
         if not os.path.isfile(str_tile_path):
-            command_array = ["pdftoppm",
-                            "-f", str(self.page),
-                            #"-l", str(self.page),
-                            "-singlefile",
-                            "-scale-to-x", str(scale_to_x),
-                            "-scale-to-y", str(scale_to_y),
-                            "-x", str(bounds[0]),
-                            "-y", str(bounds[1]),
-                            "-W", str(bounds[2] - bounds[0]),
-                            "-H", str(bounds[3] - bounds[1]),
-                            "-png",
-                            "-q",
-                            self.image_path,
-                            str_tile_path_prefix]
-            subprocess.call(command_array)
-
-            if level < self.max_level:
-                # does the image have >1 color?
-                img = Image.open(str_tile_path)
-                img_array = list(img.getdata())
-                # a small one-color image doesn't mean all subimages are one-color
-                if img.size[0] < self.tile_size or img.size[1] < self.tile_size:
-                    identical = False
-                else:
-                    identical = True
-                    for pixel in img_array:
-                        if pixel != img_array[0]:
-                            identical = False
-                            break;
-
-                if self.copy_tiles and identical:
-                    for l in range( level + 1, self.max_level + 1 ):
-                        multiplier = 2 ** (l - level)
-                        for c in range( col * multiplier, (col + 1) * multiplier ):
-                            for r in range( row * multiplier, (row + 1) * multiplier ):
-                                new_level_dir = ensure(os.path.join(dir_path, str(l)))
-                                str_new_tile_path = str(os.path.join(new_level_dir, "%s_%s.%s"%(c, r, self.format)))
-                                if not os.path.isfile(str_new_tile_path):
-                                    # There is lots of redundancy in
-                                    # checking if file exists here but
-                                    # it's low compared to other calculation
-                                    # overhead.
-                                    if self.holes:
-                                        self.dont_create_lock.acquire()
-                                        dont_create[l].add((c, r))
-                                        self.dont_create_lock.release()
-                                    else:
-                                        shutil.copyfile(str_tile_path, str_new_tile_path)
-
-        self.threads_semaphore.release()
-
-    def startJoinThreads( self, threads ):
-        for thread in threads:
-            self.threads_semaphore.acquire()
-            thread.start()
-        for thread in threads:
-            thread.join()
+            tile = self.renderRegion( scale_to_x, scale_to_y, bounds )
+            self.writeTile( dir_path, level, col, row, tile, str_tile_path, dont_create )
 
-    def save( self, parent_directory, name ):
-        dir_path = ensure( os.path.join( ensure( expand( parent_directory ) ), "%s%d_files" % (name, self.page) ) )
+    def renderTile( self, dir_path, scale_to_x, scale_to_y, level, col, row, dont_create ):
+        """ render a single tile unless an uniform tile above it left a hole there"""
+        if self.holes:
+            self.dont_create_lock.acquire()
+        hole = (col, row) in dont_create[level]
+        if self.holes:
+            self.dont_create_lock.release()
+        hole = hole or self.isInSubtree( level, col, row )
+        if not hole:
+            self.pdftoppm( dir_path, scale_to_x, scale_to_y, level, col, row, self.getTileBox( level, col, row ), dont_create )
+
+    def getBands( self, level ):
+        """ split the tile rows of a level into bands fitting in the memory limit,
+        return a list of (first row, last row + 1)"""
+        col, row = self.getLevelRowCol( level )
+        dsw, dsh = self.getLevelDimensions( level )
+        band_size = self.max_memory * 2**20 // max( 1, self.threads )
+        rows = max( 1, int( band_size // ( dsw * 3 * ( self.tile_size + 2 * self.overlap ) ) ) )
+        return [( r, min( r + rows, int( row ) ) ) for r in range( 0, int( row ), rows )]
+
+    def renderBand( self, dir_path, scale_to_x, scale_to_y, level, first_row, last_row, dont_create ):
+        """ render tile rows first_row .. last_row - 1 of a level with a single pdftoppm call
+        and cut the tiles from the band"""
+        level_dir = ensure(os.path.join(dir_path, str(level)))
+        col = int( self.getLevelRowCol( level )[0] )
+        tiles = []
+        if self.holes:
+            self.dont_create_lock.acquire()
+        for row in range( first_row, last_row ):
+            for c in range( col ):
+                str_tile_path = str(os.path.join(level_dir, "%s_%s.%s"%(c, row, self.format)))
+                if (c, row) not in dont_create[level] and not self.isInSubtree( level, c, row ) and not os.path.isfile(str_tile_path):
+                    tiles.append( ( c, row, str_tile_path ) )
+        if self.holes:
+            self.dont_create_lock.release()
+        if not tiles:
+            return
+        top = int( self.getTileBox( level, 0, first_row )[1] )
+        bottom = int( self.getTileBox( level, 0, last_row - 1 )[3] )
+        band = self.renderRegion( scale_to_x, scale_to_y, ( 0, top, scale_to_x, bottom ) )
+        for c, row, str_tile_path in tiles:
+            x1, y1, x2, y2 = map( int, self.getTileBox( level, c, row ) )
+            tile = band.crop( ( x1, y1 - top, x2, y2 - top ) )
+            self.writeTile( dir_path, level, c, row, tile, str_tile_path, dont_create )
+
+    def renderRegion( self, scale_to_x, scale_to_y, bounds ):
+        """ render a region (x1,y1,x2,y2) of the page scaled to scale_to_x x scale_to_y,
+        or take it from the render cache"""
+        if self.render_cache is None:
+            return self.runPdftoppm( scale_to_x, scale_to_y, bounds )
+        key = self.render_cache.getKey( self.image_path, self.page, scale_to_x, scale_to_y, bounds )
+        img = self.render_cache.get( key )
+        if img is None:
+            img = self.runPdftoppm( scale_to_x, scale_to_y, bounds )
+            self.render_cache.put( key, img )
+        return img
+
+    def runPdftoppm( self, scale_to_x, scale_to_y, bounds ):
+        """ the raster is read from the pipe instead of a file"""
+        command_array = ["pdftoppm",
+                        "-f", str(self.page),
+                        "-singlefile",
+                        "-scale-to-x", str(scale_to_x),
+                        "-scale-to-y", str(scale_to_y),
+                        "-x", str(bounds[0]),
+                        "-y", str(bounds[1]),
+                        "-W", str(bounds[2] - bounds[0]),
+                        "-H", str(bounds[3] - bounds[1]),
+                        "-q",
+                        self.image_path]
+        process = subprocess.Popen( command_array, stdout = subprocess.PIPE )
+        try:
+            return read_ppm( process.stdout )
+        finally:
+            process.stdout.close()
+            process.wait()
 
-        # store images
-        dont_create = [set() for n in range( self.max_level + 1 )]
+    def writeTile( self, dir_path, level, col, row, tile, str_tile_path, dont_create ):
+        """ encode and write a tile; one-color tiles are found before encoding, encoded
+        once per color and copied to their children (or leave holes there)"""
+        color = None
+        if self.copy_tiles and level < self.max_level:
+            color = self.getUniformColor( tile )
+        if color is None:
+            data = self.encodeTile( tile )
+        else:
+            key = ( tile.mode, tile.size, color )
+            data = self.uniform_tiles.get( key )
+            if data is None:
+                data = self.encodeTile( tile )
+                # near-uniform tiles differ, only one-color ones are shared
+                if self.getUniformColor( tile, 0 ) is not None:
+                    self.uniform_tiles[key] = data
+        write_file( str_tile_path, data )
+        if color is not None:
+            self.copyUniformTile( dir_path, level, col, row, data, color, str_tile_path, dont_create )
+
+    def encodeTile( self, tile ):
+        """ encode a tile, png tiles in the smallest lossless color type with png_colors"""
+        if self.format != 'png':
+            return deepzoom.encode_tile( tile, self.format, IMAGE_QUALITY )
+        if not self.png_colors:
+            return deepzoom.encode_tile( tile, self.format, IMAGE_QUALITY, self.png_options )
+        png_tile = deepzoom.get_lossless_png_image( tile )
+        data = deepzoom.encode_tile( png_tile, self.format, IMAGE_QUALITY, self.png_options )
+        if png_tile.mode == 'L':
+            kind = 'gray'
+        elif png_tile.mode == 'P':
+            kind = len( png_tile.palette.getdata()[1] ) <= 6 and '1-bit' or 'palette'
+        else:
+            kind = 'rgb'
+        rgb_bytes = len( data )
+        if self.png_savings and png_tile is not tile:
+            rgb_data = deepzoom.encode_tile( tile, self.format, IMAGE_QUALITY, self.png_options )
+            rgb_bytes = len( rgb_data )
+            if rgb_bytes < len( data ):
+                # unfiltered palette rows can lose against filtered RGB ones
+                data, kind = rgb_data, 'rgb'
+        self.dont_create_lock.acquire()
+        self.png_stats[kind] += 1
+        self.png_stats['bytes'] += len( data )
+        self.png_stats['rgb_bytes'] += rgb_bytes
+        self.dont_create_lock.release()
+        return data
+
+    def printPngStats( self ):
+        stats = self.png_stats
+        print 'png tiles of page %d: %d gray, %d 1-bit, %d palette, %d rgb, %.2f MB' % (
+            self.page, stats['gray'], stats['1-bit'], stats['palette'], stats['rgb'], stats['bytes'] / 2.0**20 ),
+        if self.png_savings and stats['rgb_bytes']:
+            saved = stats['rgb_bytes'] - stats['bytes']
+            print '(%.2f MB, %.0f%% saved)' % ( saved / 2.0**20, 100.0 * saved / stats['rgb_bytes'] )
+        else:
+            print
+
+    def getUniformColor( self, img, tolerance = None ):
+        """ return the color of a tile with all bands varying by at most tolerance
+        (uniform_tolerance by default), or None"""
+        if tolerance is None:
+            tolerance = self.uniform_tolerance
+        # a small one-color image doesn't mean all subimages are one-color
+        if img.size[0] < self.tile_size or img.size[1] < self.tile_size:
+            return None
+        extrema = img.getextrema()
+        if not isinstance( extrema[0], tuple ):
+            extrema = ( extrema, )
+        for low, high in extrema:
+            if high - low > tolerance:
+                return None
+        return tuple( ( low + high ) // 2 for low, high in extrema )
+
+    def copyUniformTile( self, dir_path, level, col, row, data, color, str_tile_path, dont_create ):
+        """ record a one-color tile as the root of a one-color subtree and copy it
+        to all of its children on the deeper levels (or leave holes there); in
+        map mode the children are left out"""
+        self.addSubtree( level, col, row, data, color )
+        if self.copy_mode == 'map':
+            return
+        original = None
+        if self.copy_mode == 'link':
+            original = self.uniform_files.setdefault( hashlib.sha1( data ).digest(), str_tile_path )
+        copied = 0
+        for l in range( level + 1, self.max_level + 1 ):
+            multiplier = 2 ** (l - level)
+            for c in range( col * multiplier, (col + 1) * multiplier ):
+                for r in range( row * multiplier, (row + 1) * multiplier ):
+                    new_level_dir = ensure(os.path.join(dir_path, str(l)))
+                    str_new_tile_path = str(os.path.join(new_level_dir, "%s_%s.%s"%(c, r, self.format)))
+                    if not os.path.isfile(str_new_tile_path):
+                        # There is lots of redundancy in
+                        # checking if file exists here but
+                        # it's low compared to other calculation
+                        # overhead.
+                        if self.holes:
+                            self.dont_create_lock.acquire()
+                            dont_create[l].add((c, r))
+                            self.dont_create_lock.release()
+                        else:
+                            self.copyTile( str_new_tile_path, data, original )
+                            copied += 1
+        self.dont_create_lock.acquire()
+        self.copied_tiles += copied
+        self.dont_create_lock.release()
+
+    def copyTile( self, path, data, original = None ):
+        """ write a copy of a tile, as a hardlink to the original if given"""
+        if original:
+            try:
+                os.link( original, path )
+                return
+            except OSError:
+                # no hardlinks on this file system
+                pass
+        write_file( path, data )
+
+    def addSubtree( self, level, col, row, data, color ):
+        """ record a one-color tile as the root of a subtree of tiles showing the
+        same as the first tile written with its content"""
+        self.dont_create_lock.acquire()
+        original = self.uniform_roots.setdefault( hashlib.sha1( data ).digest(), ( level, col, row ) )
+        self.subtrees[( level, col, row )] = original
+        self.subtree_colors[( level, col, row )] = color
+        self.dont_create_lock.release()
+
+    def isInSubtree( self, level, col, row ):
+        """ is the tile below the root of a one-color subtree? such tiles are copies
+        of the root, holes or left out, they are never rendered"""
+        if not self.subtrees:
+            return False
+        for l in range( level - 1, -1, -1 ):
+            col, row = col // 2, row // 2
+            if ( l, col, row ) in self.subtrees:
+                return True
+        return False
+
+    def writeSubtrees( self, dir_path ):
+        """ write the subtree map as {"level/col_row" of a root: "level/col_row" of its tile}"""
+        subtrees = dict( ( '%s/%s_%s' % root, '%s/%s_%s' % original )
+                         for root, original in self.subtrees.items() )
+        fh = open( os.path.join( dir_path, 'subtrees.json' ), 'w' )
+        json.dump( subtrees, fh, separators = ( ',', ':' ), sort_keys = True )
+        fh.close()
+
+    def getMissingTiles( self ):
+        """ tiles left out on purpose (holes) that no one-color subtree stands in for,
+        as {level: [[row, first col, last col], ...]}; tiles that failed to render are
+        never listed, a failure stops the run"""
+        missing = {}
         for n in range( self.min_level, self.max_level + 1 ):
+            holes = set( ( c, r ) for c, r in self.dont_create[n] if not self.isInSubtree( n, c, r ) )
+            ranges = []
+            for c, r in sorted( holes, key = lambda tile: ( tile[1], tile[0] ) ):
+                if ranges and ranges[-1][0] == r and ranges[-1][2] == c - 1:
+                    ranges[-1][2] = c
+                else:
+                    ranges.append( [r, c, c] )
+            if ranges:
+                missing[str( n )] = ranges
+        return missing
+
+    def writeSparseManifest( self, parent_directory, name ):
+        """ write <name><page>.sparse.json next to the dzi file, telling viewers which tiles
+        not to request: the generated levels, the one-color subtrees (as the tile to show
+        for all of their tiles and its color) and the tiles left out on purpose"""
+        subtrees = {}
+        for root, original in self.subtrees.items():
+            color = self.subtree_colors[root]
+            if len( color ) == 1:
+                color = color * 3
+            subtrees['%s/%s_%s' % root] = ['%s/%s_%s' % original, '#%02x%02x%02x' % color[:3]]
+        manifest = {'minLevel': self.min_level, 'maxLevel': self.max_level,
+                    'subtrees': subtrees, 'missing': self.getMissingTiles()}
+        fh = open( os.path.join( parent_directory, "%s%d.sparse.json" % (name, self.page) ), 'w' )
+        json.dump( manifest, fh, separators = ( ',', ':' ), sort_keys = True )
+        fh.close()
+
+    def getFirstRenderedLevel( self ):
+        """ the shallowest level rendered from the PDF"""
+        if not self.render_levels:
+            return self.min_level
+        return max( self.min_level, self.max_level - self.render_levels + 1 )
+
+    def iterTasks( self, dir_path, dont_create ):
+        """ tasks of all levels for the scheduler, level by level and row by row; the
+        levels reduced from the ones below them follow in a single task once all
+        rendered tiles are done"""
+        first_rendered = self.getFirstRenderedLevel()
+        for n in range( first_rendered, self.max_level + 1 ):
             print 'level: ', n
-            #level_scale = self.getLevelScale( n )
             [scale_to_x, scale_to_y] = map(int, self.getLevelDimensions ( n ))
-            threads = []
-            for (col, row), box in self.iterTiles( n ):
-                if self.holes:
-                    self.dont_create_lock.acquire()
-                if (col, row) not in dont_create[n]:
-                    threads.append(threading.Thread( target = self.pdftoppm, args = ( dir_path, scale_to_x, scale_to_y, n, col, row, box, dont_create )))
-                if self.holes:
-                    self.dont_create_lock.release()
-            thread_start_join = threading.Thread( target = self.startJoinThreads, args = ( threads, ))
-            thread_start_join.start()
-            thread_start_join.join()
+            if self.max_memory:
+                for first_row, last_row in self.getBands( n ):
+                    yield n, range( first_row, last_row ), self.renderBand, ( dir_path, scale_to_x, scale_to_y, n, first_row, last_row, dont_create )
+            else:
+                col, row = self.getLevelRowCol( n )
+                for r in range( int( row ) ):
+                    for c in range( int( col ) ):
+                        yield n, [r], self.renderTile, ( dir_path, scale_to_x, scale_to_y, n, c, r, dont_create )
+        if first_rendered > self.min_level:
+            yield first_rendered - 1, None, self.reduceLevels, ( dir_path, first_rendered )
+
+    def reduceLevels( self, dir_path, source_level ):
+        """ make the levels above source_level by halving the level below them, streamed
+        from source_level one tile row at a time (see readTileRow)"""
+        start = time.time()
+        levels = {}
+        for n in range( self.min_level, source_level ):
+            ensure( os.path.join( dir_path, str( n ) ) )
+            levels[n] = ReducedLevel( self, dir_path, n, levels )
+        source = ReducedLevel( self, dir_path, source_level, levels, save = False )
+        row = int( self.getLevelRowCol( source_level )[1] )
+        for r in range( row ):
+            source.push( self.readTileRow( dir_path, source_level, r ) )
+        self.reduce_time = time.time() - start
+        print 'levels %d-%d reduced from level %d in %.1fs' % ( self.min_level, source_level - 1, source_level, self.reduce_time )
+
+    def readTileRow( self, dir_path, level, row ):
+        """ the rows of a level covered by a tile row without the overlap, put
+        together from the png tile files; lossy tiles would hand their artifacts
+        down to every reduced level, so for those the rows are rendered again"""
+        dsw, dsh = map( int, self.getLevelDimensions( level ) )
+        col = int( self.getLevelRowCol( level )[0] )
+        top = self.tile_size * row
+        bottom = min( top + self.tile_size, dsh )
+        if self.format != 'png':
+            strip = self.renderRegion( dsw, dsh, ( 0, top, dsw, bottom ) )
+            if strip.mode != 'RGB':
+                strip = strip.convert( 'RGB' )
+            return strip
+        strip = Image.new( 'RGB', ( dsw, bottom - top ) )
+        for c in range( col ):
+            x1, y1, x2, y2 = map( int, self.getTileBox( level, c, row ) )
+            tile = self.readTile( dir_path, level, c, row, ( x2 - x1, y2 - y1 ) )
+            left = self.tile_size * c
+            strip.paste( tile.crop( ( left - x1, top - y1, left - x1 + min( self.tile_size, dsw - left ), top - y1 + strip.size[1] ) ), ( left, 0 ) )
+        return strip
+
+    def readTile( self, dir_path, level, col, row, size ):
+        """ a tile as rendered; tiles of one-color subtrees may be left out or be copies
+        of a tile of another size, these are filled with their color"""
+        path = os.path.join( dir_path, str( level ), "%s_%s.%s" % ( col, row, self.format ) )
+        if os.path.isfile( path ):
+            tile = Image.open( path )
+            if tile.mode != 'RGB':
+                tile = tile.convert( 'RGB' )
+            if tile.size == size:
+                return tile
+            color = tile.getpixel( ( 0, 0 ) )
+        else:
+            color = self.getSubtreeColor( level, col, row )
+        return Image.new( 'RGB', size, color )
+
+    def getSubtreeColor( self, level, col, row ):
+        """ color of the one-color subtree of a tile, white for tiles that failed"""
+        for l in range( level - 1, -1, -1 ):
+            col, row = col // 2, row // 2
+            color = self.subtree_colors.get( ( l, col, row ) )
+            if color is not None:
+                return len( color ) == 1 and color * 3 or color
+        return ( 255, 255, 255 )
+
+    def save( self, parent_directory, name ):
+        # store images; levels overlap, but one-color tiles decide about the
+        # tiles below them, so with holes or copies these wait for their parents
+        scheduler = PyramidScheduler( self.threads, dependencies = self.hasDependencies() )
+        scheduler.run( [self.iterSaveTasks( parent_directory, name )] )
+        self.level_times = scheduler.getLevelTimes()
+        self.worker_stats = scheduler.getWorkerStats()
+        for i, stats in enumerate( self.worker_stats ):
+            print 'worker %d: %d tasks, %.0f%% busy' % ( i, stats['tasks'], 100 * stats['utilization'] )
+        if self.render_cache is not None:
+            self.render_cache.printStats()
+        self.finishSave( parent_directory, name )
+
+    def hasDependencies( self ):
+        """ do tiles depend on the tiles above them?"""
+        return bool( self.holes or self.copy_tiles )
+
+    def getFilesPath( self, parent_directory, name ):
+        return os.path.join( expand( parent_directory ), "%s%d_files" % (name, self.page) )
+
+    def iterSaveTasks( self, parent_directory, name ):
+        """ tasks rendering all tiles, see save"""
+        ensure( expand( parent_directory ) )
+        dir_path = ensure( self.getFilesPath( parent_directory, name ) )
+        # tiles left out under one-color tiles, kept for the sparse manifest
+        self.dont_create = [set() for n in range( self.max_level + 1 )]
+        return self.iterTasks( dir_path, self.dont_create )
+
+    def finishSave( self, parent_directory, name ):
+        """ pack the tiles and write the dzi file once all tiles are rendered"""
+        dir_path = self.getFilesPath( parent_directory, name )
+        if self.copy_mode == 'map':
+            self.writeSubtrees( dir_path )
+            print 'one-color subtrees: %d' % len( self.subtrees )
+        elif self.copied_tiles:
+            print 'one-color tiles copied: %d (%s)' % ( self.copied_tiles, self.copy_mode )
+        self.writeSparseManifest( parent_directory, name )
+        if self.png_colors:
+            self.printPngStats()
+        # tiles are rendered into files first, holes and copies rely on them
+        if self.pack:
+            tilepack.pack( dir_path, os.path.join( parent_directory, "%s%d.dzp" % (name, self.page) ) )
+            shutil.rmtree( dir_path )
 
         # store dzi file
         fh = open( os.path.join( parent_directory, "%s%d.dzi" % (name, self.page)), 'w+' )
@@ -253,14 +632,361 @@ class PyramidComposer( object ):
                 if n > self.max_level*.75  and n < self.max_level*.95:
                     print  "  ", "%s/%s_%s"%(n, col, row ), box
 
+class ReducedLevel( object ):
+    """ rows of a pyramid level made by halving the level below it, handed down from
+    that level band by band as in deepzoom's band mode; tiles are saved as soon as
+    their rows are complete and pairs of rows are passed on to the level above"""
+    def __init__( self, composer, dir_path, level, levels, save = True ):
+        self.composer = composer
+        self.dir_path = dir_path
+        self.level = level
+        self.levels = levels
+        self.width, self.height = map( int, composer.getLevelDimensions( level ) )
+        col, row = composer.getLevelRowCol( level )
+        self.cols, self.rows = int( col ), int( row )
+        # rows [top, bottom) of the level
+        self.image = None
+        self.top = 0
+        self.bottom = 0
+        # next tile row to save and number of rows passed to the level above
+        self.row = 0
+        self.reduced = 0
+        if not save:
+            # the rows are only carried up to the level above
+            self.row = self.rows
+
+    def push( self, image ):
+        """ append rows directly below the ones already held"""
+        self.image = deepzoom.append_rows( self.image, image )
+        self.bottom += image.size[1]
+        composer = self.composer
+        while self.row < self.rows:
+            if composer.getTileBox( self.level, 0, self.row )[3] > self.bottom:
+                break
+            for c in range( self.cols ):
+                x1, y1, x2, y2 = map( int, composer.getTileBox( self.level, c, self.row ) )
+                tile = self.image.crop( ( x1, y1 - self.top, x2, y2 - self.top ) )
+                path = os.path.join( self.dir_path, str( self.level ), "%s_%s.%s" % ( c, self.row, composer.format ) )
+                write_file( path, composer.encodeTile( tile ) )
+            self.row += 1
+        above = self.levels.get( self.level - 1 )
+        if above:
+            count = self.bottom - self.reduced
+            if self.bottom < self.height:
+                # rows are reduced in pairs, the odd one waits for the next band
+                count -= count % 2
+            if count > 0:
+                start = self.reduced - self.top
+                above.push( deepzoom.reduce_half( self.image.crop( ( 0, start, self.width, start + count ) ) ) )
+                self.reduced += count
+        if self.row < self.rows:
+            next_top = int( composer.getTileBox( self.level, 0, self.row )[1] )
+        else:
+            next_top = self.height
+        if above:
+            next_top = min( next_top, self.reduced )
+        if next_top >= self.bottom:
+            self.image = None
+            self.top = self.bottom
+        elif next_top > self.top:
+            self.image = self.image.crop( ( 0, next_top - self.top, self.width, self.bottom - self.top ) )
+            self.top = next_top
+
+class PyramidScheduler( object ):
+    """ runs tasks of all pyramid levels on a fixed pool of worker threads fed
+    through a bounded queue; with dependencies a task waits until the rows of
+    the level above covering its rows are done. Tasks without rows (None) wait
+    for all tasks of their group queued before them. Tasks of several pyramids
+    (groups) are taken in turns, skipping groups waiting for their rows. The
+    first failing task stops the run, run raises its exception"""
+    def __init__( self, threads, queue_size = None, dependencies = False ):
+        self.threads = max( 1, threads )
+        self.queue = Queue.Queue( queue_size or 4 * self.threads )
+        self.dependencies = dependencies
+        self.condition = threading.Condition()
+        # unfinished tasks of (group, level, row)
+        self.pending = {}
+        self.busy = [0.0] * self.threads
+        self.tasks = [0] * self.threads
+        # (group, level): [first task start, last task end]
+        self.level_spans = {}
+        self.seconds = 0
+        # exc_info of the first failed task
+        self.error = None
+
+    def run( self, groups ):
+        """ run a list of task groups, each an iterable of tasks (level, rows, function, args)
+        given in the order of levels"""
+        workers = [threading.Thread( target = self.work, args = ( i, ) ) for i in range( self.threads )]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        try:
+            # [group, iterator, next task] of groups with tasks left
+            active = []
+            for group, tasks in enumerate( groups ):
+                iterator = iter( tasks )
+                for task in iterator:
+                    active.append( [group, iterator, task] )
+                    break
+            while active:
+                self.condition.acquire()
+                while not self.error and not self.isReady( active[0][0], active[0][2] ):
+                    for i in range( 1, len( active ) ):
+                        if self.isReady( active[i][0], active[i][2] ):
+                            active.insert( 0, active.pop( i ) )
+                            break
+                    else:
+                        self.condition.wait()
+                if self.error:
+                    self.condition.release()
+                    break
+                group, iterator, ( level, rows, function, args ) = active[0]
+                for r in rows or ():
+                    self.pending[( group, level, r )] = self.pending.get( ( group, level, r ), 0 ) + 1
+                self.condition.release()
+                self.queue.put( ( group, level, rows, function, args ) )
+                # take turns with the other groups
+                entry = active.pop( 0 )
+                for task in iterator:
+                    entry[2] = task
+                    active.append( entry )
+                    break
+        finally:
+            for worker in workers:
+                self.queue.put( None )
+            for worker in workers:
+                worker.join()
+            self.seconds = time.time() - start
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def isReady( self, group, task ):
+        """ are the rows of the level above the task done? call with the condition held"""
+        level, rows = task[:2]
+        if rows is None:
+            for key in self.pending:
+                if key[0] == group:
+                    return False
+            return True
+        if not self.dependencies:
+            return True
+        for r in set( r // 2 for r in rows ):
+            if self.pending.get( ( group, level - 1, r ) ):
+                return False
+        return True
+
+    def work( self, index ):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            group, level, rows, function, args = task
+            start = time.time()
+            error = None
+            if not self.error:
+                # tasks queued before a failure are dropped
+                try:
+                    function( *args )
+                except Exception:
+                    error = sys.exc_info()
+                    print >> sys.stderr, 'level %d, rows %s of pyramid %d failed:' % ( level, rows, group )
+                    traceback.print_exc()
+            end = time.time()
+            self.condition.acquire()
+            if error and not self.error:
+                self.error = error
+            self.busy[index] += end - start
+            self.tasks[index] += 1
+            span = self.level_spans.setdefault( ( group, level ), [start, end] )
+            span[0] = min( span[0], start )
+            span[1] = max( span[1], end )
+            for r in rows or ():
+                self.pending[( group, level, r )] -= 1
+                if not self.pending[( group, level, r )]:
+                    del self.pending[( group, level, r )]
+            self.condition.notifyAll()
+            self.condition.release()
+
+    def getLevelTimes( self, group = 0 ):
+        """ wall time of every level of a group, from its first task start to its last task end"""
+        return dict( ( level, end - start ) for ( g, level ), ( start, end ) in self.level_spans.items()
+                     if g == group )
+
+    def getWorkerStats( self ):
+        """ number of tasks and busy time fraction of every worker"""
+        return [{'tasks': self.tasks[i], 'busy': self.busy[i],
+                 'utilization': self.seconds and self.busy[i] / self.seconds}
+                for i in range( self.threads )]
+
+class RenderCache( object ):
+    """ rendered regions on disk, keyed by the SHA-1 of the PDF content, the page,
+    the scale and the bounds of the region, so they survive changes of levels,
+    tile format or output path and re-uploads of the same document. Regions are
+    stored as zlib compressed PPM images, the least recently used ones are
+    removed when the cache grows over max_size bytes"""
+    def __init__( self, directory, max_size = RENDER_CACHE_SIZE * 2**20 ):
+        self.directory = ensure( expand( directory ) )
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # digests of documents by (path, mtime, size)
+        self.digests = {}
+        # sizes of the cached regions by key, least recently used first
+        self.items = OrderedDict()
+        found = []
+        for name in os.listdir( self.directory ):
+            if name.endswith( '.ppz' ):
+                stat = os.stat( os.path.join( self.directory, name ) )
+                found.append( ( stat.st_mtime, name[:-4], stat.st_size ) )
+        for mtime, key, size in sorted( found ):
+            self.items[key] = size
+            self.size += size
+
+    def getDigest( self, pdf_path ):
+        """ SHA-1 of a document, computed once while the file doesn't change"""
+        stat = os.stat( pdf_path )
+        file_key = ( os.path.abspath( pdf_path ), stat.st_mtime, stat.st_size )
+        self.lock.acquire()
+        digest = self.digests.get( file_key )
+        self.lock.release()
+        if digest is None:
+            sha = hashlib.sha1()
+            f = open( pdf_path, 'rb' )
+            for chunk in iter( lambda: f.read( 2**20 ), '' ):
+                sha.update( chunk )
+            f.close()
+            digest = sha.hexdigest()
+            self.lock.acquire()
+            self.digests[file_key] = digest
+            self.lock.release()
+        return digest
+
+    def getKey( self, pdf_path, page, scale_to_x, scale_to_y, bounds ):
+        region = '%s %d %d %d %d %d %d %d' % ( ( self.getDigest( pdf_path ), page, scale_to_x, scale_to_y ) + tuple( bounds ) )
+        return hashlib.sha1( region ).hexdigest()
+
+    def getPath( self, key ):
+        return os.path.join( self.directory, key + '.ppz' )
+
+    def get( self, key ):
+        """ the cached region or None"""
+        self.lock.acquire()
+        cached = key in self.items
+        if cached:
+            self.items[key] = self.items.pop( key )
+        self.lock.release()
+        img = None
+        if cached:
+            try:
+                f = open( self.getPath( key ), 'rb' )
+                data = f.read()
+                f.close()
+                img = read_ppm( StringIO( zlib.decompress( data ) ) )
+                os.utime( self.getPath( key ), None )
+            except ( IOError, OSError, zlib.error ):
+                # removed or cut short by another process
+                img = None
+        self.lock.acquire()
+        if img is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.lock.release()
+        return img
+
+    def put( self, key, img ):
+        """ store a region, removing the least recently used ones if the cache gets too big"""
+        header = '%s\n%d %d\n255\n' % ( img.mode == 'L' and 'P5' or 'P6', img.size[0], img.size[1] )
+        data = zlib.compress( header + img.tobytes(), 1 )
+        if len( data ) > self.max_size:
+            return
+        path = self.getPath( key )
+        temp_path = '%s.%s.tmp' % ( path, threading.current_thread().ident )
+        write_file( temp_path, data )
+        os.rename( temp_path, path )
+        evicted = []
+        self.lock.acquire()
+        self.size += len( data ) - self.items.pop( key, 0 )
+        self.items[key] = len( data )
+        while self.size > self.max_size:
+            old_key, size = self.items.popitem( last = False )
+            self.size -= size
+            evicted.append( old_key )
+        self.lock.release()
+        for old_key in evicted:
+            try:
+                os.remove( self.getPath( old_key ) )
+            except OSError:
+                pass
+
+    def getStats( self ):
+        self.lock.acquire()
+        stats = {'hits': self.hits, 'misses': self.misses, 'items': len( self.items ),
+                 'size': self.size, 'max_size': self.max_size}
+        self.lock.release()
+        return stats
+
+    def printStats( self ):
+        stats = self.getStats()
+        lookups = stats['hits'] + stats['misses']
+        print 'render cache: %d hits, %d misses (%.0f%% hits), %d regions, %.1f MB' % (
+            stats['hits'], stats['misses'], lookups and 100.0 * stats['hits'] / lookups,
+            stats['items'], stats['size'] / 2.0**20 )
+
 def expand( d):
     return os.path.abspath( os.path.expanduser( os.path.expandvars( d ) ) )
 
 def ensure( d ):
     if not os.path.exists( d ):
-        os.mkdir( d )
+        try:
+            os.mkdir( d )
+        except OSError:
+            # created by another thread in the meantime
+            if not os.path.isdir( d ):
+                raise
     return d
 
+def write_file( path, data ):
+    f = open( path, 'wb' )
+    f.write( data )
+    f.close()
+
+def read_ppm( stream ):
+    """ read a binary PPM (or PGM) image from a stream """
+    tokens = []
+    token = ''
+    while len( tokens ) < 4:
+        char = stream.read( 1 )
+        if not char:
+            raise IOError( 'Truncated PPM header' )
+        if char == '#':
+            # comment till the end of line
+            while char not in ( '\n', '' ):
+                char = stream.read( 1 )
+        if char.isspace():
+            if token:
+                tokens.append( token )
+                token = ''
+        else:
+            token += char
+    magic, width, height, maxval = tokens[0], int( tokens[1] ), int( tokens[2] ), int( tokens[3] )
+    if magic not in ( 'P5', 'P6' ) or maxval != 255:
+        raise IOError( 'Unsupported PPM image: %s, maxval %s' % ( magic, maxval ) )
+    mode = magic == 'P6' and 'RGB' or 'L'
+    data = stream.read( width * height * len( mode ) )
+    if len( data ) < width * height * len( mode ):
+        raise IOError( 'Truncated PPM image' )
+    return Image.frombuffer( mode, ( width, height ), data, 'raw', mode, 0, 1 )
+
+def get_render_cache( options ):
+    """ RenderCache of the --render-cache options or None"""
+    if not options.render_cache:
+        return None
+    return RenderCache( options.render_cache, options.render_cache_size * 2**20 )
+
 def main( ):
     parser = optparse.OptionParser(usage = "usage: %prog [options] filename")
     parser.add_option('-W', '--width', dest="width", type="int", help="Image width")
@@ -274,6 +1000,17 @@ def main( ):
     parser.add_option('-f', '--format', dest="format", default="png", help = 'Set the Image Format (jpg or png)')
     parser.add_option('--holes', dest="holes", type="int", default=0, help = 'Generating with holes is faster but 404 errors are generated')
     parser.add_option('--copy-tiles', dest="copy_tiles", type="int", default=0, help = 'Try to see if tile is one-color and copy it to it\'s "children" if so')
+    parser.add_option('--copy-mode', dest="copy_mode", choices=COPY_MODES, default='copy', help = 'How one-color tiles reach their children: copy, link (hardlinks) or map (left out and listed in _files/subtrees.json). Default: copy')
+    parser.add_option('--uniform-tolerance', dest="uniform_tolerance", type="int", default=0, help = 'How much the colors of a tile may vary for it to count as one-color (0-255), e.g. for anti-aliased paper')
+    parser.add_option('--pack', dest="pack", action="store_true", default=False, help = 'Pack all tiles into a single .dzp file')
+    parser.add_option('--max-memory', dest="max_memory", type="int", help = 'Render whole rows of tiles with one pdftoppm call, in bands fitting in the given number of megabytes')
+    parser.add_option('--render-levels', dest="render_levels", type="int", default=0, help = 'Render only this many of the deepest levels from the PDF and reduce the others from the level below them. For jpg tiles that level is rendered once more instead of decoding its tiles. Default: all levels')
+    parser.add_option('--render-cache', dest="render_cache", help = 'Keep rendered regions in this directory and reuse them in later runs')
+    parser.add_option('--render-cache-size', dest="render_cache_size", type="int", default=RENDER_CACHE_SIZE, help = 'Size of the render cache in megabytes. Default: %d' % RENDER_CACHE_SIZE)
+    parser.add_option('--png-colors', dest="png_colors", action="store_true", default=False, help = 'Write png tiles as 1-bit, palette or grayscale images when no pixel changes')
+    parser.add_option('--png-compress-level', dest="png_compress_level", type="int", help = 'zlib compression level of png tiles (0-9, lower is faster). Default: 6')
+    parser.add_option('--png-strategy', dest="png_strategy", choices=sorted(PNG_STRATEGIES), help = 'zlib strategy of png tiles (%s)' % ', '.join(sorted(PNG_STRATEGIES)))
+    parser.add_option('--png-savings', dest="png_savings", action="store_true", default=False, help = 'Also encode tiles as RGB, keep the smaller file and report the bytes saved by --png-colors')
     parser.add_option('-n', '--name', dest="name", help = 'Set the name of the output directory/dzi')
     parser.add_option('-p', '--path', dest="path", help = 'Set the path of the output directory/dzi')
     parser.add_option('-t', '--transform', dest="transform", default="antialias", help = 'Type of Transform (bicubic, nearest, antialias, bilinear')
@@ -303,12 +1040,20 @@ def main( ):
         options.path = os.path.dirname( image_path )
     if options.transform and options.transform in filter_map:
         options.transform = filter_map[ options.transform ]
+    if options.pack and options.copy_mode == 'map':
+        parser.error( 'the map copy mode can\'t be packed, packs store identical tiles once anyway' )
 
     composer = PyramidComposer( image_path=image_path, width=options.width, height=options.height,
             tile_size=options.size, overlap=options.overlap,
             min_level=options.min_level, max_level=options.max_level,
             format=options.format, filter=options.transform, threads=options.threads,
-            page=options.page, holes=options.holes, copy_tiles=options.copy_tiles )
+            page=options.page, holes=options.holes, copy_tiles=options.copy_tiles,
+            pack=options.pack, max_memory=options.max_memory,
+            uniform_tolerance=options.uniform_tolerance,
+            render_cache=get_render_cache( options ), copy_mode=options.copy_mode,
+            render_levels=options.render_levels, png_colors=options.png_colors,
+            png_compress_level=options.png_compress_level, png_strategy=options.png_strategy,
+            png_savings=options.png_savings )
 
     if options.debug:
         composer.info()
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Deep Zoom pyramids of all pages of a PDF document
+
+Reads the MediaBoxes of all pages with a single pdfinfo call and renders
+the tiles of all pages on one shared pool of worker threads, so that the
+pages of a long document are rendered side by side instead of one after
+another. Every page becomes <name><page>.dzi as written by
+my_deepzoom_pdf.py; <name>.json lists them all:
+
+    {"source": "doc.pdf", "pages": [{"page": 1, "dzi": "doc1.dzi", "width": 5950,
+     "height": 8420, "multiplier": 10, "mediaBox": [0, 0, 595, 842],
+     "sparse": "doc1.sparse.json"}, ...]}
+
+With --png-colors the pages also list the numbers of tiles of every png
+color type and their bytes ("pngStats").
+
+Page sizes are the MediaBox sizes in points times a multiplier (10 by
+default), which can be set for single pages with --page-multiplier.
+
+Usage:
+    my_deepzoom_pdf_all.py [options] document.pdf [pages]
+"""
+
+import json, optparse, os, re, subprocess, sys
+
+from my_deepzoom_pdf import PyramidComposer, PyramidScheduler, COPY_MODES, PNG_STRATEGIES, RENDER_CACHE_SIZE, expand, ensure, filter_map, get_render_cache
+
+PAGE_BOX = re.compile( r'^(?:Page\s+(\d+)\s+)?MediaBox:\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)' )
+PAGE_ROTATION = re.compile( r'^(?:Page\s+(\d+)\s+)?rot:\s+(\d+)' )
+
+
+def get_page_count( pdf_path ):
+    """ number of pages of a PDF document"""
+    for line in pdfinfo( pdf_path ).splitlines():
+        if line.startswith( 'Pages:' ):
+            return int( line.split()[1] )
+    raise IOError( 'No page count in pdfinfo output for %s' % pdf_path )
+
+def get_page_boxes( pdf_path, pages ):
+    """ returns {page: (mediaBox, rotation)} of pages 1 to pages, read in one pass"""
+    boxes = {}
+    rotations = {}
+    for line in pdfinfo( pdf_path, '-box', '-f', '1', '-l', str( pages ) ).splitlines():
+        match = PAGE_BOX.match( line )
+        if match:
+            boxes[int( match.group( 1 ) or 1 )] = tuple( float( v ) for v in match.groups()[1:] )
+            continue
+        match = PAGE_ROTATION.match( line )
+        if match:
+            rotations[int( match.group( 1 ) or 1 )] = int( match.group( 2 ) )
+    missing = [page for page in range( 1, pages + 1 ) if page not in boxes]
+    if missing:
+        raise IOError( 'No MediaBox for pages %s of %s' % ( missing, pdf_path ) )
+    return dict( ( page, ( boxes[page], rotations.get( page, 0 ) ) ) for page in boxes )
+
+def get_page_size( box, rotation, multiplier ):
+    """ size in pixels of a page rendered at multiplier pixels per point"""
+    x1, y1, x2, y2 = box
+    width, height = int( multiplier * ( x2 - x1 ) ), int( multiplier * ( y2 - y1 ) )
+    if rotation % 180:
+        return height, width
+    return width, height
+
+def pdfinfo( pdf_path, *args ):
+    process = subprocess.Popen( ['pdfinfo'] + list( args ) + [pdf_path], stdout = subprocess.PIPE )
+    output = process.communicate()[0]
+    if process.returncode:
+        raise IOError( 'pdfinfo failed on %s' % pdf_path )
+    return output
+
+def parse_multipliers( values ):
+    """ {page: multiplier} of PAGE=MULTIPLIER option values"""
+    multipliers = {}
+    for value in values:
+        page, _, multiplier = value.partition( '=' )
+        multipliers[int( page )] = float( multiplier )
+    return multipliers
+
+def save_document( composers, path, name, threads ):
+    """ render the pyramids of all composers on one pool of worker threads"""
+    scheduler = PyramidScheduler( threads, dependencies = any( c.hasDependencies() for c in composers ) )
+    scheduler.run( [composer.iterSaveTasks( path, name ) for composer in composers] )
+    for composer in composers:
+        composer.finishSave( path, name )
+    for i, stats in enumerate( scheduler.getWorkerStats() ):
+        print 'worker %d: %d tasks, %.0f%% busy' % ( i, stats['tasks'], 100 * stats['utilization'] )
+    if composers and composers[0].render_cache is not None:
+        composers[0].render_cache.printStats()
+    return scheduler
+
+def write_manifest( manifest_path, pdf_path, name, pages, composers ):
+    """ pages: list of (page, width, height, multiplier, box) of the composers"""
+    manifest = {'source': os.path.basename( pdf_path ), 'pages': []}
+    for ( page, width, height, multiplier, box ), composer in zip( pages, composers ):
+        entry = {'page': page, 'dzi': '%s%d.dzi' % ( name, page ),
+                 'sparse': '%s%d.sparse.json' % ( name, page ),
+                 'width': width, 'height': height,
+                 'multiplier': multiplier, 'mediaBox': list( box )}
+        if composer.png_colors:
+            entry['pngStats'] = composer.png_stats
+        manifest['pages'].append( entry )
+    fh = open( manifest_path, 'w' )
+    json.dump( manifest, fh, sort_keys = True, indent = 1 )
+    fh.close()
+
+def main( ):
+    parser = optparse.OptionParser(usage = "usage: %prog [options] filename [pages]")
+    parser.add_option('-m', '--multiplier', dest="multiplier", type="float", default=10, help = 'Pixels per PDF point. Default: 10')
+    parser.add_option('--page-multiplier', dest="page_multipliers", action="append", default=[], metavar="PAGE=MULTIPLIER", help = 'Pixels per PDF point of a single page, may be repeated')
+    parser.add_option('-s', '--tile-size', dest = "size", type="int", default=256, help = 'The tile height/width')
+    parser.add_option('--overlap', dest = "overlap", type="int", default=1, help = 'How much tiles are overlapping')
+    parser.add_option('--min-level', dest="min_level", type="int", default=0, help = 'Min level to generate')
+    parser.add_option('-l', '--max-level', dest="max_level", type="int", default=0, help = 'Max level to generate')
+    parser.add_option('-f', '--format', dest="format", default="png", help = 'Set the Image Format (jpg or png)')
+    parser.add_option('--holes', dest="holes", type="int", default=0, help = 'Generating with holes is faster but 404 errors are generated')
+    parser.add_option('--copy-tiles', dest="copy_tiles", type="int", default=0, help = 'Try to see if tile is one-color and copy it to it\'s "children" if so')
+    parser.add_option('--copy-mode', dest="copy_mode", choices=COPY_MODES, default='copy', help = 'How one-color tiles reach their children: copy, link (hardlinks) or map (left out and listed in _files/subtrees.json). Default: copy')
+    parser.add_option('--uniform-tolerance', dest="uniform_tolerance", type="int", default=0, help = 'How much the colors of a tile may vary for it to count as one-color (0-255)')
+    parser.add_option('--pack', dest="pack", action="store_true", default=False, help = 'Pack the tiles of every page into a single .dzp file')
+    parser.add_option('--max-memory', dest="max_memory", type="int", help = 'Render whole rows of tiles with one pdftoppm call, in bands fitting in the given number of megabytes')
+    parser.add_option('--render-levels', dest="render_levels", type="int", default=0, help = 'Render only this many of the deepest levels from the PDF and reduce the others from the level below them. For jpg tiles that level is rendered once more instead of decoding its tiles. Default: all levels')
+    parser.add_option('--render-cache', dest="render_cache", help = 'Keep rendered regions in this directory and reuse them in later runs')
+    parser.add_option('--render-cache-size', dest="render_cache_size", type="int", default=RENDER_CACHE_SIZE, help = 'Size of the render cache in megabytes. Default: %d' % RENDER_CACHE_SIZE)
+    parser.add_option('--png-colors', dest="png_colors", action="store_true", default=False, help = 'Write png tiles as 1-bit, palette or grayscale images when no pixel changes')
+    parser.add_option('--png-compress-level', dest="png_compress_level", type="int", help = 'zlib compression level of png tiles (0-9, lower is faster). Default: 6')
+    parser.add_option('--png-strategy', dest="png_strategy", choices=sorted(PNG_STRATEGIES), help = 'zlib strategy of png tiles (%s)' % ', '.join(sorted(PNG_STRATEGIES)))
+    parser.add_option('--png-savings', dest="png_savings", action="store_true", default=False, help = 'Also encode tiles as RGB, keep the smaller file and report the bytes saved by --png-colors')
+    parser.add_option('-n', '--name', dest="name", help = 'Set the name of the output directories/dzis')
+    parser.add_option('-p', '--path', dest="path", help = 'Set the path of the output directories/dzis')
+    parser.add_option('-t', '--transform', dest="transform", default="antialias", help = 'Type of Transform (bicubic, nearest, antialias, bilinear')
+    parser.add_option('-j', '--threads', dest = "threads", type = "int", default = 2, help = 'Number of threads shared by all pages')
+
+    (options, args ) = parser.parse_args()
+
+    if len( args ) not in ( 1, 2 ):
+        parser.print_help()
+        sys.exit(1)
+    pdf_path = expand( args[0] )
+    if not options.name:
+        options.name = os.path.splitext( os.path.basename( pdf_path ) )[0]
+    if not options.path:
+        options.path = os.path.dirname( pdf_path )
+    if options.transform and options.transform in filter_map:
+        options.transform = filter_map[ options.transform ]
+    if options.pack and options.copy_mode == 'map':
+        parser.error( 'the map copy mode can\'t be packed, packs store identical tiles once anyway' )
+
+    page_count = len( args ) == 2 and int( args[1] ) or get_page_count( pdf_path )
+    boxes = get_page_boxes( pdf_path, page_count )
+    multipliers = parse_multipliers( options.page_multipliers )
+
+    render_cache = get_render_cache( options )
+    pages = []
+    composers = []
+    for page in range( 1, page_count + 1 ):
+        box, rotation = boxes[page]
+        multiplier = multipliers.get( page, options.multiplier )
+        width, height = get_page_size( box, rotation, multiplier )
+        pages.append( ( page, width, height, multiplier, box ) )
+        composers.append( PyramidComposer( image_path=pdf_path, width=width, height=height,
+                tile_size=options.size, overlap=options.overlap,
+                min_level=options.min_level, max_level=options.max_level,
+                format=options.format, filter=options.transform, threads=options.threads,
+                page=page, holes=options.holes, copy_tiles=options.copy_tiles,
+                pack=options.pack, max_memory=options.max_memory,
+                uniform_tolerance=options.uniform_tolerance, render_cache=render_cache,
+                copy_mode=options.copy_mode, render_levels=options.render_levels,
+                png_colors=options.png_colors, png_compress_level=options.png_compress_level,
+                png_strategy=options.png_strategy, png_savings=options.png_savings ) )
+
+    ensure( expand( options.path ) )
+    save_document( composers, options.path, options.name, options.threads )
+    write_manifest( os.path.join( expand( options.path ), '%s.json' % options.name ), pdf_path, options.name, pages, composers )
+    print '%d pages written to %s' % ( page_count, options.path )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Packed Deep Zoom tiles
+
+A pack keeps all tiles of a pyramid in a single file instead of a
+<name>_files/<level>/<column>_<row>.<format> tree. The file starts with a
+magic string, followed by the tile bytes concatenated one after another
+and an index of fixed size records sorted by (level, column, row):
+
+    level (uint16), column (uint32), row (uint32), offset (uint64), length (uint32)
+
+The file ends with the offset of the index, the number of records and the
+magic string again. Readers map the file into memory and binary search the
+index in place, so opening a pack costs the same for ten or ten million
+tiles and tiles are served without copying them.
+
+Usage:
+    tilepack.py pack image_files image.dzp
+    tilepack.py unpack image.dzp image_files
+"""
+
+import hashlib
+import mmap
+import optparse
+import os
+import re
+import struct
+import sys
+
+MAGIC = 'DZPACK01'
+INDEX_RECORD = struct.Struct('<HIIQI')
+FOOTER = struct.Struct('<QQ8s')
+
+TILE_NAME = re.compile(r'^(\d+)_(\d+)\.(\w+)$')
+
+# Formats recognized from the first bytes of a tile
+TILE_SIGNATURES = (
+    ('\xff\xd8\xff', 'jpg'),
+    ('\x89PNG\r\n\x1a\n', 'png'),
+    )
+
+
+class TilePackWriter(object):
+    """Writes tiles into a new pack file."""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.index = {}
+
+    def write(self, level, column, row, data):
+        """Appends a tile to the pack."""
+        self.file.write(data)
+        self.index[(level, column, row)] = (self.offset, len(data))
+        self.offset += len(data)
+
+    def link(self, key, original):
+        """Adds a tile (level, column, row) sharing the bytes of a tile
+        written before."""
+        self.index[key] = self.index[original]
+
+    def close(self):
+        """Writes the index and closes the pack."""
+        for key in sorted(self.index):
+            self.file.write(INDEX_RECORD.pack(*(key + self.index[key])))
+        self.file.write(FOOTER.pack(self.offset, len(self.index), MAGIC))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TilePackReader(object):
+    """Reads tiles from a pack file through a memory map."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < len(MAGIC) + FOOTER.size or self.map[:len(MAGIC)] != MAGIC:
+            raise IOError('Not a tile pack: %s' % path)
+        footer_offset = len(self.map) - FOOTER.size
+        self.index_offset, self.count, magic = FOOTER.unpack_from(self.map, footer_offset)
+        if magic != MAGIC:
+            raise IOError('Truncated tile pack: %s' % path)
+
+    def _record(self, i):
+        return INDEX_RECORD.unpack_from(self.map, self.index_offset + i * INDEX_RECORD.size)
+
+    def _find(self, level, column, row):
+        key = (level, column, row)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[:3] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count:
+            record = self._record(low)
+            if record[:3] == key:
+                return record[3:]
+        return None
+
+    def get_tile(self, level, column, row):
+        """Returns a read-only buffer with the bytes of a tile (or None if
+        the pack doesn't have it) backed directly by the memory map."""
+        found = self._find(level, column, row)
+        if found is None:
+            return None
+        offset, length = found
+        return buffer(self.map, offset, length)
+
+    def __contains__(self, key):
+        return self._find(*key) is not None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Iterator for all tiles in the pack. Returns (level, column, row) of a tile."""
+        for i in xrange(self.count):
+            yield self._record(i)[:3]
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_tile_format(data):
+    """Returns the format of a tile from its first bytes."""
+    for signature, format in TILE_SIGNATURES:
+        if data[:len(signature)] == signature:
+            return format
+    if data[:4] == 'RIFF' and data[8:12] == 'WEBP':
+        return 'webp'
+    return None
+
+def iter_tile_files(files_path):
+    """Iterator for all tiles in a _files tree.
+    Returns (level, column, row, path) of a tile."""
+    for level_name in os.listdir(files_path):
+        level_path = os.path.join(files_path, level_name)
+        if not level_name.isdigit() or not os.path.isdir(level_path):
+            continue
+        for name in os.listdir(level_path):
+            match = TILE_NAME.match(name)
+            if match:
+                yield (int(level_name), int(match.group(1)), int(match.group(2)),
+                       os.path.join(level_path, name))
+
+def pack(files_path, pack_path):
+    """Packs a _files tree into a single pack file. Identical tiles are
+    stored once."""
+    digests = {}
+    with TilePackWriter(pack_path) as writer:
+        for level, column, row, path in sorted(iter_tile_files(files_path)):
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha1(data).digest()
+            if digest in digests:
+                writer.link((level, column, row), digests[digest])
+            else:
+                writer.write(level, column, row, data)
+                digests[digest] = (level, column, row)
+
+def unpack(pack_path, files_path, tile_format=None):
+    """Unpacks a pack file into a _files tree. Tile file extensions are
+    taken from the tiles themselves unless tile_format is given."""
+    with TilePackReader(pack_path) as reader:
+        for level, column, row in reader:
+            data = reader.get_tile(level, column, row)
+            format = tile_format or get_tile_format(data) or 'jpg'
+            level_path = os.path.join(files_path, str(level))
+            if not os.path.exists(level_path):
+                os.makedirs(level_path)
+            path = os.path.join(level_path, '%s_%s.%s' % (column, row, format))
+            with open(path, 'wb') as f:
+                f.write(data)
+
+def get_pack_path(path):
+    """Path of the pack file belonging to a DZI file."""
+    return os.path.splitext(path)[0] + '.dzp'
+
+################################################################################
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog pack files_dir pack_file\n'
+                                         '       %prog unpack pack_file files_dir')
+    parser.add_option('-f', '--tile_format', dest='tile_format',
+                      help='Extension of unpacked tiles. Default: detected from the tiles')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 3 or args[0] not in ('pack', 'unpack'):
+        parser.print_help()
+        sys.exit(1)
+
+    command, source, destination = args
+    if command == 'pack':
+        pack(source, destination)
+    else:
+        unpack(source, destination, options.tile_format)
+
+if __name__ == '__main__':
+    main()